@@ -9,18 +9,25 @@ Usa API MTProto de baixo nível para:
 """
 
 import asyncio
+import functools
 import os
 import time
 import logging
-import hashlib
-import random
+import io
+import json
+import secrets
+import shutil
+import tempfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from typing import AsyncGenerator, BinaryIO
 
 from telethon import TelegramClient
+from telethon.sessions import StringSession
 from telethon.tl.types import (
     Message, DocumentAttributeVideo, DocumentAttributeFilename,
-    InputFileBig, InputMediaUploadedDocument, InputReplyToMessage
+    InputFileBig, InputMediaUploadedDocument, InputReplyToMessage, PhotoSize,
+    PhotoSizeProgressive
 )
 from telethon.tl.functions.upload import SaveBigFilePartRequest
 from telethon.tl.functions.messages import SendMediaRequest
@@ -35,6 +42,13 @@ except ImportError:
     FORUM_SUPPORT = False
     logging.warning("Forum Topics não suportado nesta versão do Telethon")
 
+# uvloop (event loop em libuv) - opcional, mais rápido com muitos chunks em voo
+try:
+    import uvloop
+    UVLOOP_SUPPORT = True
+except ImportError:
+    UVLOOP_SUPPORT = False
+
 # ============================================================
 # CONFIGURAÇÃO
 # ============================================================
@@ -45,6 +59,82 @@ API_HASH = os.environ['TG_API_HASH']
 SOURCE_CHAT = int(os.environ['SOURCE_CHAT'])
 TARGET_CHAT = int(os.environ['TARGET_CHAT'])
 
+# IDs aleatórios de 63 bits com sinal (random_id / file_id do MTProto)
+def _random_id() -> int:
+    return secrets.randbits(63) - (1 << 62)
+
+
+def _attr_map(doc) -> dict:
+    """Índice {tipo: atributo} do documento, montado uma vez e guardado nele."""
+    m = doc.__dict__.get('_sc_attr_map')
+    if m is None:
+        m = doc.__dict__['_sc_attr_map'] = {type(a): a for a in doc.attributes}
+    return m
+
+
+def _remove_quiet(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _cleanup(*paths):
+    """Remove temporários em paralelo no executor, fora do event loop."""
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(
+        *(loop.run_in_executor(None, _remove_quiet, p) for p in paths if p),
+        return_exceptions=True
+    )
+
+
+_PREFETCH_END = object()
+
+
+async def _prefetch(source, maxsize: int) -> AsyncGenerator:
+    """
+    Consome um async iterator em background, até maxsize itens à frente.
+    A busca da próxima página (iter_messages) sobrepõe o clone da atual.
+    """
+    queue = asyncio.Queue(maxsize)
+
+    async def produce():
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_PREFETCH_END)
+        except Exception as e:
+            await queue.put(e)  # Repassado ao consumidor
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _PREFETCH_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+
+async def _iter_messages_resumable(client, chat, min_id: int, **kwargs) -> AsyncGenerator:
+    """
+    iter_messages (reverse=True) que sobrevive a FloodWait longo: o Telethon só
+    dorme sozinho até flood_sleep_threshold; acima disso espera aqui e reabre a
+    iteração a partir do último id entregue.
+    """
+    while True:
+        try:
+            async for msg in client.iter_messages(chat, min_id=min_id, reverse=True, **kwargs):
+                min_id = msg.id
+                yield msg
+            return
+        except FloodWaitError as e:
+            log.warning(f"FloodWait ao buscar mensagens: {e.seconds}s (retomando após {min_id})")
+            await asyncio.sleep(e.seconds + 1)
+
 # Helper para converter topic ID (trata string vazia)
 def _parse_topic(val):
     if not val or val.strip() == '':
@@ -59,17 +149,36 @@ AUTO_CREATE_TOPICS = os.environ.get('AUTO_CREATE_TOPICS', 'true').lower() == 'tr
 
 # Topic mapping file (para persistência)
 TOPIC_MAP_FILE = 'topic_map.json'
+TOPIC_MAP_LOG = 'topic_map.log'  # Criações de tópico (append-only), compactadas no JSON
+TOPIC_MAP_SAVE_DELAY = 1.0  # Segundos para agrupar escritas do topic_map
+FORUM_TOPICS_PAGE = 100     # Tópicos por GetForumTopicsRequest (máximo da API)
 
 # Streaming config
 CHUNK_SIZE = 512 * 1024  # 512KB por chunk (máximo MTProto)
 PARALLEL_UPLOADS = 10     # Chunks em paralelo no upload
 BUFFER_CHUNKS = 20        # Chunks em buffer (~10MB)
+PREFETCH_MESSAGES = 500   # Mensagens buscadas à frente do clone
+# Conexões MTProto para upload de partes (mesma auth_key; 1 = só o client principal)
+UPLOAD_CONNECTIONS = int(os.environ.get('UPLOAD_CONNECTIONS', '1'))
+# Limite global de partes em voo (somado entre todos os uploads simultâneos)
+_UPLOAD_SEMAPHORE = asyncio.BoundedSemaphore(PARALLEL_UPLOADS)
 
 # Rate limit - Telegram permite ~30-50 msg/min
 MIN_INTERVAL = 1.3  # ~46 msg/min (seguro dentro do limite)
+RATE_LIMIT_BURST = 5  # Mensagens permitidas em rajada (token bucket)
+
+# Temporários pequenos (mídia <10MB, previews, thumbnails) em tmpfs quando
+# disponível - evita writeback em disco. Vídeos grandes com watermark
+# continuam no tempdir em disco (DISK_TMP_DIR) para não consumir RAM.
+DISK_TMP_DIR = tempfile.gettempdir()
+TMP_DIR = os.environ.get('TMP_DIR') or (
+    '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK)
+    else DISK_TMP_DIR
+)
 
 # Checkpoint
 CHECKPOINT_FILE = 'checkpoint.txt'
+CHECKPOINT_FLUSH_INTERVAL = 2.0  # Segundos para agrupar escritas do checkpoint
 
 # Watermark
 WATERMARK_PATH = os.path.expanduser('~/watermark.png')
@@ -79,6 +188,11 @@ WATERMARK_ENABLED = os.path.exists(WATERMARK_PATH)
 # Default: 50MB. Use 0 para desabilitar limite (watermark em todos).
 WATERMARK_MAX_SIZE_MB = int(os.environ.get('WATERMARK_MAX_SIZE_MB', '50'))
 WATERMARK_MAX_SIZE = WATERMARK_MAX_SIZE_MB * 1024 * 1024  # Converter para bytes
+# Vídeos grandes: download → FFmpeg → upload via pipes, sem o arquivo em disco.
+# Se o FFmpeg não conseguir ler a origem via pipe, cai no fluxo em disco.
+WATERMARK_PIPE = os.environ.get('WATERMARK_PIPE', 'true').lower() == 'true'
+# Encode H.264 na GPU (NVENC) quando houver uma utilizável; senão libx264
+VIDEO_HWENC = os.environ.get('VIDEO_HWENC', 'true').lower() == 'true'
 
 # ============================================================
 # LOGGING
@@ -101,34 +215,104 @@ log = logging.getLogger(__name__)
 import subprocess
 from PIL import Image
 
-def add_watermark_video(input_path: str, output_path: str) -> bool:
+# PyAV - opcional, extrai thumbnails em processo (sem fork/exec de ffmpeg)
+try:
+    import av
+    PYAV_SUPPORT = True
+except ImportError:
+    PYAV_SUPPORT = False
+
+# Binário do FFmpeg resolvido uma vez (evita busca no PATH a cada chamada)
+FFMPEG_BIN = shutil.which('ffmpeg') or 'ffmpeg'
+
+# FFmpeg/Pillow são bloqueantes: rodam em threads para o event loop continuar
+# atendendo uploads. O trabalho pesado fica no subprocesso/C (sem GIL).
+_MEDIA_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='media')
+
+async def _run_media(func, *args, **kwargs):
+    call = functools.partial(func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_MEDIA_EXECUTOR, call)
+
+# Filtro complexo para 2 watermarks em diagonal.
+# A watermark é convertida para yuva420p uma única vez (antes do split) e o
+# overlay mistura direto em yuv420, que já é o formato de saída do libx264 -
+# evita as conversões RGB/YUV por frame.
+WATERMARK_FILTER = (
+    '[1:v]scale=iw*0.225:-1,format=yuva420p,split=2[wm1][wm2];'
+    '[0:v][wm1]overlay=10:10:format=yuv420[tmp1];'
+    '[tmp1][wm2]overlay=W-w-10:H-h-10:format=yuv420'
+)
+
+X264_ARGS = (
+    '-c:v', 'libx264',
+    '-preset', 'ultrafast',
+    '-crf', '23',
+    '-threads', '0',
+)
+NVENC_ARGS = (
+    '-c:v', 'h264_nvenc',
+    '-preset', 'p1',
+    '-tune', 'll',
+    '-rc', 'vbr',
+    '-cq', '23',
+)
+
+@functools.lru_cache(maxsize=1)
+def _video_encoder_args() -> tuple:
+    """
+    Argumentos do encoder de vídeo, detectados uma vez.
+    NVENC só é usado se um encode de teste funcionar - o build do FFmpeg pode
+    ter h264_nvenc sem haver GPU/driver na máquina. O overlay continua na CPU.
+    """
+    if VIDEO_HWENC:
+        try:
+            probe = subprocess.run([
+                FFMPEG_BIN, '-hide_banner', '-v', 'error',
+                '-f', 'lavfi', '-i', 'color=s=256x256:d=0.1',
+                *NVENC_ARGS, '-f', 'null', '-'
+            ], capture_output=True, timeout=30)
+            if probe.returncode == 0:
+                log.info("Encoder de vídeo: h264_nvenc (GPU)")
+                return NVENC_ARGS
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+    return X264_ARGS
+
+def _progress_total_size(progress: bytes) -> int | None:
+    """Extrai o último total_size reportado pelo -progress do FFmpeg."""
+    total_size = None
+    for line in progress.decode(errors='ignore').splitlines():
+        if line.startswith('total_size='):
+            value = line[len('total_size='):]
+            if value.isdigit():
+                total_size = int(value)
+    return total_size
+
+
+def add_watermark_video(input_path: str, output_path: str, input_size: int | None = None) -> bool:
     """
     Adiciona watermark em vídeo usando FFmpeg.
     Posiciona em diagonal: superior esquerdo e inferior direito.
+
+    input_size evita um stat no arquivo de entrada quando o chamador já sabe o tamanho.
     """
     try:
         # Verificar tamanho do arquivo de entrada
-        input_size = os.path.getsize(input_path)
+        if input_size is None:
+            input_size = os.stat(input_path).st_size
         if input_size < 1000:
             log.warning(f"Arquivo de entrada muito pequeno: {input_size} bytes")
             return False
 
-        # Filtro complexo para 2 watermarks em diagonal
-        filter_complex = (
-            '[1:v]scale=iw*0.225:-1,split=2[wm1][wm2];'
-            '[0:v][wm1]overlay=10:10[tmp1];'
-            '[tmp1][wm2]overlay=W-w-10:H-h-10'
-        )
         cmd = [
-            'ffmpeg', '-y',
+            FFMPEG_BIN, '-y',
+            '-nostats', '-progress', 'pipe:1',
             '-i', input_path,
             '-i', WATERMARK_PATH,
-            '-filter_complex', filter_complex,
-            '-c:v', 'libx264',
+            '-filter_complex', WATERMARK_FILTER,
+            *_video_encoder_args(),
+            '-pix_fmt', 'yuv420p',
             '-c:a', 'copy',
-            '-preset', 'ultrafast',
-            '-crf', '23',
-            '-threads', '0',
             '-movflags', '+faststart',
             output_path
         ]
@@ -138,12 +322,15 @@ def add_watermark_video(input_path: str, output_path: str) -> bool:
             log.warning(f"FFmpeg erro: {result.stderr.decode()[-300:]}")
             return False
 
-        # Verificar se arquivo de saída existe e tem tamanho razoável
-        if not os.path.exists(output_path):
-            log.warning("FFmpeg não criou arquivo de saída")
-            return False
+        # Tamanho de saída vem do próprio FFmpeg (-progress); stat só se ausente
+        output_size = _progress_total_size(result.stdout)
+        if output_size is None:
+            try:
+                output_size = os.stat(output_path).st_size
+            except FileNotFoundError:
+                log.warning("FFmpeg não criou arquivo de saída")
+                return False
 
-        output_size = os.path.getsize(output_path)
         if output_size < 1000:
             log.warning(f"Arquivo de saída muito pequeno: {output_size} bytes")
             os.remove(output_path)
@@ -165,6 +352,77 @@ def add_watermark_video(input_path: str, output_path: str) -> bool:
         return False
 
 
+# Pontos de tempo para tentar extrair frame (em segundos)
+# Inclui mais pontos para vídeos longos que podem ter keyframes esparsos
+THUMB_TIME_POINTS = ['0', '0.5', '1', '2', '3', '5', '10']
+THUMB_WIDTH = 320
+# Frames analisados pelo filtro thumbnail (~4s a 25fps) na tentativa única
+THUMB_SCAN_FRAMES = 100
+
+
+def _generate_thumbnail_pyav(video_path: str, thumb_path: str) -> bool:
+    """
+    Gera thumbnail com PyAV: abre o vídeo uma vez e tenta todos os pontos
+    de tempo com o decoder aquecido. Seek por keyframe (como -ss antes de -i).
+    """
+    try:
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            for time_point in THUMB_TIME_POINTS:
+                try:
+                    container.seek(int(float(time_point) * av.time_base), any_frame=False)
+                    frame = next(container.decode(stream), None)
+                    if frame is None:
+                        continue
+
+                    image = frame.to_image()
+                    height = max(1, round(image.height * THUMB_WIDTH / image.width))
+                    image.resize((THUMB_WIDTH, height), Image.Resampling.BILINEAR).save(
+                        thumb_path, 'JPEG', quality=90
+                    )
+
+                    thumb_size = os.path.getsize(thumb_path)
+                    if thumb_size > 100:
+                        log.debug(f"Thumbnail (PyAV) gerado em t={time_point}s: {thumb_size} bytes")
+                        return True
+                    os.remove(thumb_path)
+                except Exception as e:
+                    log.debug(f"PyAV falhou em t={time_point}s: {e}")
+    except Exception as e:
+        log.debug(f"PyAV não abriu {video_path}: {e}")
+    return False
+
+
+def _generate_thumbnail_single_pass(video_path: str, thumb_path: str) -> bool:
+    """
+    Uma única chamada do FFmpeg: o filtro thumbnail escolhe o frame mais
+    representativo entre os primeiros THUMB_SCAN_FRAMES (evita frame preto
+    inicial). Decodifica desde o início, então serve também para previews.
+    """
+    try:
+        result = subprocess.run([
+            FFMPEG_BIN, '-y',
+            '-fflags', '+discardcorrupt',
+            '-i', video_path,
+            '-map', '0:v:0', '-an', '-sn', '-dn',
+            '-vf', f'thumbnail={THUMB_SCAN_FRAMES},scale={THUMB_WIDTH}:-1',
+            '-frames:v', '1',
+            '-q:v', '2',
+            thumb_path
+        ], capture_output=True, timeout=60)
+        if result.returncode != 0:
+            return False
+        thumb_size = os.path.getsize(thumb_path)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.debug(f"Thumbnail em passada única falhou: {e}")
+        return False
+    if thumb_size > 100:
+        log.debug(f"Thumbnail gerado (passada única): {thumb_size} bytes")
+        return True
+    os.remove(thumb_path)
+    return False
+
+
 def generate_video_thumbnail(video_path: str, thumb_path: str, is_preview: bool = False) -> bool:
     """
     Gera thumbnail de vídeo de forma robusta.
@@ -176,33 +434,42 @@ def generate_video_thumbnail(video_path: str, thumb_path: str, is_preview: bool
     Returns:
         True se thumbnail foi gerado com sucesso, False caso contrário.
     """
-    # Pontos de tempo para tentar extrair frame (em segundos)
-    # Inclui mais pontos para vídeos longos que podem ter keyframes esparsos
-    time_points = ['0', '0.5', '1', '2', '3', '5', '10']
+    # Vídeo completo: tentar em processo com PyAV antes de chamar o ffmpeg
+    if PYAV_SUPPORT and not is_preview:
+        if _generate_thumbnail_pyav(video_path, thumb_path):
+            return True
 
-    for time_point in time_points:
+    # Um único processo FFmpeg; os pontos de tempo abaixo ficam como fallback
+    if _generate_thumbnail_single_pass(video_path, thumb_path):
+        return True
+
+    for time_point in THUMB_TIME_POINTS:
         try:
             # Para previews de vídeos grandes: -ss DEPOIS de -i (mais preciso, mais lento)
             # Para vídeos completos: -ss ANTES de -i (mais rápido, usa keyframe seeking)
             if is_preview:
                 # Modo preciso: decodifica desde o início até o timestamp
                 thumb_cmd = [
-                    'ffmpeg', '-y',
+                    FFMPEG_BIN, '-y',
+                    '-fflags', '+discardcorrupt',
                     '-i', video_path,
                     '-ss', time_point,
-                    '-vframes', '1',
-                    '-vf', 'scale=320:-1',
+                    '-map', '0:v:0', '-an', '-sn', '-dn',
+                    '-frames:v', '1',
+                    '-vf', f'scale={THUMB_WIDTH}:-1',
                     '-q:v', '2',
                     thumb_path
                 ]
             else:
                 # Modo rápido: seek por keyframe
                 thumb_cmd = [
-                    'ffmpeg', '-y',
+                    FFMPEG_BIN, '-y',
+                    '-fflags', '+discardcorrupt+fastseek',
                     '-ss', time_point,
                     '-i', video_path,
-                    '-vframes', '1',
-                    '-vf', 'scale=320:-1',
+                    '-map', '0:v:0', '-an', '-sn', '-dn',
+                    '-frames:v', '1',
+                    '-vf', f'scale={THUMB_WIDTH}:-1',
                     '-q:v', '2',
                     thumb_path
                 ]
@@ -218,14 +485,15 @@ def generate_video_thumbnail(video_path: str, thumb_path: str, is_preview: bool
                 continue
 
             # Verificar se arquivo foi criado e tem conteúdo válido
-            if os.path.exists(thumb_path):
+            try:
                 thumb_size = os.path.getsize(thumb_path)
-                if thumb_size > 100:  # Thumbnail válido tem pelo menos 100 bytes
-                    log.debug(f"Thumbnail gerado em t={time_point}s: {thumb_size} bytes")
-                    return True
-                else:
-                    # Arquivo muito pequeno, provavelmente inválido
-                    os.remove(thumb_path)
+            except FileNotFoundError:
+                continue
+            if thumb_size > 100:  # Thumbnail válido tem pelo menos 100 bytes
+                log.debug(f"Thumbnail gerado em t={time_point}s: {thumb_size} bytes")
+                return True
+            # Arquivo muito pequeno, provavelmente inválido
+            os.remove(thumb_path)
 
         except subprocess.TimeoutExpired:
             log.debug(f"Timeout gerando thumbnail em t={time_point}s")
@@ -238,20 +506,56 @@ def generate_video_thumbnail(video_path: str, thumb_path: str, is_preview: bool
     return False
 
 
+def generate_preview_thumbnail(chunks: list, preview_path: str, thumb_path: str) -> bool:
+    """Grava os chunks de preview de uma vez e gera o thumbnail (roda no executor)."""
+    with open(preview_path, 'wb') as f:
+        f.writelines(chunks)
+    # is_preview=True usa seeking preciso (mais lento, mas funciona com arquivos parciais)
+    return generate_video_thumbnail(preview_path, thumb_path, is_preview=True)
+
+
+# Formatos de imagem aceitos no watermark (fotos do Telegram são JPEG)
+IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+@functools.lru_cache(maxsize=1)
+def _load_watermark() -> Image.Image:
+    """Decodifica a watermark uma única vez (arquivo constante)."""
+    with Image.open(WATERMARK_PATH) as watermark:
+        return watermark.convert('RGBA')
+
+
+# Larguras de imagem são agrupadas em faixas de 64px para reaproveitar o resize
+WATERMARK_WIDTH_BUCKET = 64
+
+@functools.lru_cache(maxsize=32)
+def _scaled_watermark(base_width: int) -> Image.Image:
+    """
+    Watermark com 22.5% da largura da imagem (50% maior que 15%).
+    O resultado é compartilhado entre chamadas - não modificar.
+    """
+    watermark = _load_watermark()
+    wm_width = int(base_width * 0.225)
+    wm_height = max(1, int(watermark.height * wm_width / watermark.width))
+    return watermark.resize((wm_width, wm_height), Image.Resampling.LANCZOS)
+
+
 def add_watermark_image(input_path: str, output_path: str) -> bool:
     """
     Adiciona watermark em imagem usando Pillow.
     Posiciona em diagonal: superior esquerdo, centro e inferior direito.
     """
     try:
-        base = Image.open(input_path).convert('RGBA')
-        watermark = Image.open(WATERMARK_PATH).convert('RGBA')
-
-        # Redimensionar watermark para 22.5% da largura da imagem (50% maior que 15%)
-        wm_width = int(base.width * 0.225)
-        wm_ratio = wm_width / watermark.width
-        wm_height = int(watermark.height * wm_ratio)
-        watermark = watermark.resize((wm_width, wm_height), Image.Resampling.LANCZOS)
+        # Formatos explícitos evitam testar todos os plugins do Pillow
+        base = Image.open(input_path, formats=IMAGE_FORMATS)
+        # paste() com máscara alfa já compõe em C direto sobre RGB/RGBA:
+        # JPEG (RGB) não precisa ir e voltar de RGBA no frame inteiro
+        if base.mode not in ('RGB', 'RGBA'):
+            base = base.convert('RGBA')
+
+        # Watermark redimensionada (cache por faixa de largura)
+        bucket = max(WATERMARK_WIDTH_BUCKET, base.width // WATERMARK_WIDTH_BUCKET * WATERMARK_WIDTH_BUCKET)
+        watermark = _scaled_watermark(bucket)
+        wm_width, wm_height = watermark.size
 
         # Posições em diagonal (sem o centro)
         positions = [
@@ -267,7 +571,8 @@ def add_watermark_image(input_path: str, output_path: str) -> bool:
         if output_path.lower().endswith('.png'):
             base.save(output_path, 'PNG')
         else:
-            base = base.convert('RGB')
+            if base.mode != 'RGB':
+                base = base.convert('RGB')
             base.save(output_path, 'JPEG', quality=95)
 
         return True
@@ -290,29 +595,73 @@ class TopicManager:
         self.client = client
         self.topic_map: dict[int, int] = {}  # source_topic_id -> target_topic_id
         self.source_topics: dict[int, str] = {}  # topic_id -> topic_name
+        self._dirty = False
+        self._save_task: asyncio.Task | None = None
+        self._log_entries = 0  # Linhas em TOPIC_MAP_LOG ainda não compactadas
         self._load_map()
     
     def _load_map(self):
-        """Carrega mapeamento de tópicos do arquivo."""
-        import json
+        """Carrega mapeamento de tópicos do arquivo + criações registradas no log."""
         if os.path.exists(TOPIC_MAP_FILE):
             try:
                 with open(TOPIC_MAP_FILE, 'r') as f:
                     data = json.load(f)
                     self.topic_map = {int(k): int(v) for k, v in data.get('map', {}).items()}
                     self.source_topics = {int(k): v for k, v in data.get('names', {}).items()}
-                log.info(f"📋 Carregado mapeamento de {len(self.topic_map)} tópicos")
             except Exception as e:
                 log.warning(f"Erro ao carregar topic_map: {e}")
+        try:
+            with open(TOPIC_MAP_LOG, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Linha truncada (queda durante a escrita)
+                    self.topic_map[int(entry['src'])] = int(entry['tgt'])
+                    self._log_entries += 1
+        except FileNotFoundError:
+            pass
+        if self.topic_map:
+            log.info(f"📋 Carregado mapeamento de {len(self.topic_map)} tópicos")
+    
+    def _append_log(self, source_topic_id: int, target_topic_id: int):
+        """Registra uma criação de tópico em O(1), sem reescrever o mapa inteiro."""
+        with open(TOPIC_MAP_LOG, 'a') as f:
+            f.write(json.dumps({'src': source_topic_id, 'tgt': target_topic_id}) + '\n')
+        self._log_entries += 1
     
     def _save_map(self):
-        """Salva mapeamento de tópicos no arquivo."""
-        import json
-        with open(TOPIC_MAP_FILE, 'w') as f:
+        """Salva snapshot do mapeamento (escrita atômica) e descarta o log."""
+        tmp_file = f"{TOPIC_MAP_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
             json.dump({
                 'map': {str(k): v for k, v in self.topic_map.items()},
                 'names': {str(k): v for k, v in self.source_topics.items()}
-            }, f, indent=2)
+            }, f)
+        os.replace(tmp_file, TOPIC_MAP_FILE)
+        # Snapshot já contém tudo que estava no log
+        _remove_quiet(TOPIC_MAP_LOG)
+        self._log_entries = 0
+        self._dirty = False
+    
+    def _schedule_save(self):
+        """Marca o mapa como alterado e agenda uma única escrita em breve."""
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._debounced_save(TOPIC_MAP_SAVE_DELAY))
+    
+    async def _debounced_save(self, delay: float):
+        """Agrupa várias criações de tópico em uma escrita."""
+        await asyncio.sleep(delay)
+        if self._dirty:
+            self._save_map()
+    
+    async def flush(self):
+        """Grava alterações pendentes imediatamente (usar ao encerrar)."""
+        if self._save_task and not self._save_task.done():
+            self._save_task.cancel()
+        if self._dirty or self._log_entries:
+            self._save_map()
     
     async def load_source_topics(self, source_chat: int):
         """Carrega informações dos tópicos do chat de origem."""
@@ -321,18 +670,35 @@ class TopicManager:
             return
         
         try:
-            result = await self.client(GetForumTopicsRequest(
-                channel=source_chat,
-                offset_date=0,
-                offset_id=0,
-                offset_topic=0,
-                limit=100
-            ))
-            
-            for topic in result.topics:
-                if hasattr(topic, 'id') and hasattr(topic, 'title'):
-                    self.source_topics[topic.id] = topic.title
+            # Paginar: a API retorna no máximo FORUM_TOPICS_PAGE tópicos por chamada
+            offset_date, offset_id, offset_topic = 0, 0, 0
+            while True:
+                result = await self.client(GetForumTopicsRequest(
+                    channel=source_chat,
+                    offset_date=offset_date,
+                    offset_id=offset_id,
+                    offset_topic=offset_topic,
+                    limit=FORUM_TOPICS_PAGE
+                ))
+                
+                for topic in result.topics:
+                    if hasattr(topic, 'id') and hasattr(topic, 'title'):
+                        self.source_topics[topic.id] = topic.title
+                
+                if len(result.topics) < FORUM_TOPICS_PAGE:
+                    break
+                last = result.topics[-1]
+                if last.id == offset_topic:
+                    break
+                offset_topic = last.id
+                offset_id = getattr(last, 'top_message', 0) or 0
+                # Tópicos vêm ordenados por última atividade: o offset_date é a data da
+                # top_message (em result.messages), não ForumTopic.date (criação)
+                top = next((m for m in result.messages if m.id == offset_id), None)
+                offset_date = top.date if top else 0
             
+            # Persistir nomes junto do mapeamento
+            self._schedule_save()
             log.info(f"📚 Carregados {len(self.source_topics)} tópicos da origem")
         except Exception as e:
             log.warning(f"Não foi possível carregar tópicos da origem: {e}")
@@ -371,12 +737,21 @@ class TopicManager:
         try:
             log.info(f"📝 Criando tópico no destino: '{topic_name}'")
             
-            result = await self.client(CreateForumTopicRequest(
-                channel=target_chat,
-                title=topic_name,
-                icon_color=0x6FB9F0,  # Cor azul padrão
-                random_id=random.randrange(-2**62, 2**62)
-            ))
+            while True:
+                try:
+                    result = await self.client(CreateForumTopicRequest(
+                        channel=target_chat,
+                        title=topic_name,
+                        icon_color=0x6FB9F0,  # Cor azul padrão
+                        random_id=_random_id()
+                    ))
+                    break
+                except FloodWaitError as e:
+                    log.warning(f"FloodWait ao criar tópico: {e.seconds}s")
+                    await asyncio.sleep(e.seconds + 1)
+                    # Outra tarefa pode ter criado o tópico durante a espera
+                    if source_topic_id in self.topic_map:
+                        return self.topic_map[source_topic_id]
             
             # O ID do tópico é o ID da primeira mensagem (updates)
             new_topic_id = None
@@ -388,18 +763,13 @@ class TopicManager:
             
             if new_topic_id:
                 self.topic_map[source_topic_id] = new_topic_id
-                self._save_map()
+                self._append_log(source_topic_id, new_topic_id)
                 log.info(f"✓ Tópico criado: '{topic_name}' (ID: {new_topic_id})")
                 return new_topic_id
             else:
                 log.error(f"Não foi possível obter ID do tópico criado")
                 return TARGET_TOPIC
                 
-        except FloodWaitError as e:
-            log.warning(f"FloodWait ao criar tópico: {e.seconds}s")
-            await asyncio.sleep(e.seconds + 1)
-            return await self.get_or_create_target_topic(source_topic_id, target_chat)
-            
         except Exception as e:
             log.error(f"Erro ao criar tópico '{topic_name}': {e}")
             return TARGET_TOPIC
@@ -408,67 +778,113 @@ class TopicManager:
 # STREAMING UPLOADER
 # ============================================================
 
+class UploadPool:
+    """
+    Conexões extras para SaveBigFilePartRequest, distribuídas por parte.
+    Cada uma é um TelegramClient com a mesma auth_key da sessão principal,
+    sem receber updates - só multiplica as conexões TCP de upload.
+    """
+
+    def __init__(self, client: TelegramClient):
+        self.clients = [client]
+
+    async def start(self, connections: int):
+        if connections <= 1:
+            return
+        session = StringSession.save(self.clients[0].session)
+        for _ in range(connections - 1):
+            extra = TelegramClient(StringSession(session), API_ID, API_HASH, receive_updates=False)
+            await extra.connect()
+            self.clients.append(extra)
+        log.info(f"Upload: {len(self.clients)} conexões")
+
+    async def close(self):
+        for extra in self.clients[1:]:
+            await extra.disconnect()
+        del self.clients[1:]
+
+
 class StreamingUploader:
     """
     Upload de arquivo grande em streaming.
     Não precisa ter o arquivo completo para começar.
     """
     
-    def __init__(self, client: TelegramClient, file_size: int, file_name: str):
+    def __init__(self, client: TelegramClient, file_size: int | None, file_name: str,
+                 upload_clients: list | None = None, on_flood_wait=None):
         self.client = client
+        self.on_flood_wait = on_flood_wait  # Coroutine chamada antes de dormir num FloodWait
+        self.upload_clients = upload_clients or [client]
         self.file_size = file_size
         self.file_name = file_name
         
         # Gerar file_id único
-        self.file_id = random.randrange(-2**62, 2**62)
+        self.file_id = _random_id()
         
         # Calcular total de partes
-        self.total_parts = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.total_parts = -1
+        if file_size is not None:
+            self.set_file_size(file_size)
         
         # Controle
         self.parts_uploaded = 0
-        self.md5_hash = hashlib.md5()
-        
-        # Semáforo para limitar uploads paralelos
-        self.semaphore = asyncio.Semaphore(PARALLEL_UPLOADS)
         
-        # Fila de chunks pendentes
-        self.pending_tasks = []
+        # Fila limitada de chunks pendentes (backpressure: ~BUFFER_CHUNKS em RAM)
+        self.pending_tasks: asyncio.Queue = asyncio.Queue(maxsize=BUFFER_CHUNKS)
     
+    def set_file_size(self, file_size: int):
+        """Define o tamanho final; sem ele as partes vão com total -1 (streaming)."""
+        self.file_size = file_size
+        self.total_parts = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
     async def upload_part(self, part_index: int, data: bytes) -> bool:
         """Upload de uma parte do arquivo."""
-        async with self.semaphore:
-            try:
-                result = await self.client(SaveBigFilePartRequest(
-                    file_id=self.file_id,
-                    file_part=part_index,
-                    file_total_parts=self.total_parts,
-                    bytes=data
-                ))
-                
-                if result:
-                    self.parts_uploaded += 1
-                    self.md5_hash.update(data)
-                    return True
-                return False
-                
-            except FloodWaitError as e:
-                log.warning(f"FloodWait no upload: {e.seconds}s")
-                await asyncio.sleep(e.seconds + 1)
-                return await self.upload_part(part_index, data)
+        client = self.upload_clients[part_index % len(self.upload_clients)]
+        async with _UPLOAD_SEMAPHORE:
+            # FloodWait: esperar segurando o slot (freia todos os uploads) e repetir
+            # no mesmo slot - recursão readquiriria o semáforo e podia travar
+            while True:
+                try:
+                    result = await client(SaveBigFilePartRequest(
+                        file_id=self.file_id,
+                        file_part=part_index,
+                        file_total_parts=self.total_parts,
+                        bytes=data
+                    ))
+                    break
+                except FloodWaitError as e:
+                    log.warning(f"FloodWait no upload: {e.seconds}s")
+                    if self.on_flood_wait:
+                        await self.on_flood_wait()
+                    await asyncio.sleep(e.seconds + 1)
+
+        if result:
+            self.parts_uploaded += 1
+            return True
+        return False
     
     async def upload_chunk(self, part_index: int, data: bytes):
         """Agenda upload de um chunk (não bloqueia)."""
         task = asyncio.create_task(self.upload_part(part_index, data))
-        self.pending_tasks.append(task)
-        
-        # Limpar tasks completadas
-        self.pending_tasks = [t for t in self.pending_tasks if not t.done()]
+
+        # Buffer cheio: aguardar o chunk mais antigo (propaga erro imediatamente)
+        if self.pending_tasks.full():
+            await self.pending_tasks.get_nowait()
+        self.pending_tasks.put_nowait(task)
     
     async def wait_completion(self):
         """Aguarda todos os uploads pendentes."""
-        if self.pending_tasks:
-            await asyncio.gather(*self.pending_tasks)
+        while not self.pending_tasks.empty():
+            await self.pending_tasks.get_nowait()
+
+    async def cancel(self):
+        """Cancela os uploads pendentes e aguarda o encerramento (abortar o arquivo)."""
+        tasks = []
+        while not self.pending_tasks.empty():
+            task = self.pending_tasks.get_nowait()
+            task.cancel()
+            tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
     
     def get_input_file(self) -> InputFileBig:
         """Retorna InputFile para usar no sendMedia."""
@@ -490,20 +906,72 @@ class StreamingCloner:
     Suporta criação automática de tópicos.
     """
     
-    def __init__(self, client: TelegramClient, topic_manager: TopicManager = None):
+    def __init__(self, client: TelegramClient, topic_manager: TopicManager = None,
+                 upload_pool: UploadPool = None, checkpoint: 'CheckpointWriter' = None):
         self.client = client
+        self.upload_clients = upload_pool.clients if upload_pool else [client]
         self.topic_manager = topic_manager
-        self.last_send_time = 0
+        self.checkpoint = checkpoint
+        # Token bucket: começa cheio
+        self._tokens = float(RATE_LIMIT_BURST)
+        self._last_refill = time.monotonic()
+        self._target_peer = None  # InputPeer do destino, resolvido uma vez
+        self._reply_to_cache: dict[int, InputReplyToMessage] = {}
+    
+    async def _flush_checkpoint(self):
+        """Grava o checkpoint antes de dormir num FloodWait (queda na espera não reclona)."""
+        if self.checkpoint:
+            await self.checkpoint.flush()
+    
+    async def _get_target_peer(self):
+        """Resolve TARGET_CHAT uma única vez por clonador."""
+        if self._target_peer is None:
+            self._target_peer = await self.client.get_input_entity(TARGET_CHAT)
+        return self._target_peer
+    
+    def _reply_to(self, topic: int | None) -> InputReplyToMessage | None:
+        """InputReplyToMessage por tópico (poucos tópicos, objeto reaproveitado)."""
+        if not topic:
+            return None
+        reply_to = self._reply_to_cache.get(topic)
+        if reply_to is None:
+            reply_to = self._reply_to_cache[topic] = InputReplyToMessage(reply_to_msg_id=topic)
+        return reply_to
     
     async def wait_rate_limit(self):
-        """Aguarda rate limit de 20 msgs/min."""
-        elapsed = time.time() - self.last_send_time
-        if elapsed < MIN_INTERVAL:
-            await asyncio.sleep(MIN_INTERVAL - elapsed)
-        self.last_send_time = time.time()
+        """
+        Token bucket: permite rajadas de até RATE_LIMIT_BURST mensagens,
+        mantendo a média de 1 mensagem a cada MIN_INTERVAL.
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        if elapsed > 0:
+            self._tokens = min(RATE_LIMIT_BURST, self._tokens + elapsed / MIN_INTERVAL)
+            self._last_refill = now
+        # Reservar o token antes de dormir (seguro com chamadas concorrentes)
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens * MIN_INTERVAL)
+    
+    def drain_rate_limit(self, seconds: float):
+        """Esvazia o bucket após FloodWait; recarga só recomeça depois da espera."""
+        self._tokens = 0.0
+        self._last_refill = time.monotonic() + seconds
     
     async def clone_message(self, msg: Message) -> bool:
         """Clona uma mensagem com streaming."""
+        # FloodWait em loop: recursão manteria frames (e buffers) vivos durante o sleep
+        while True:
+            try:
+                return await self._clone_message_once(msg)
+            except FloodWaitError as e:
+                log.warning(f"FloodWait: {e.seconds}s")
+                self.drain_rate_limit(e.seconds + 1)
+                await self._flush_checkpoint()
+                await asyncio.sleep(e.seconds + 1)
+
+    async def _clone_message_once(self, msg: Message) -> bool:
+        """Uma tentativa de clone; FloodWaitError sobe para clone_message."""
         
         await self.wait_rate_limit()
         
@@ -561,10 +1029,9 @@ class StreamingCloner:
             log.warning(f"⊘ Tipo não suportado: msg {msg.id}")
             return False
             
-        except FloodWaitError as e:
-            log.warning(f"FloodWait: {e.seconds}s")
-            await asyncio.sleep(e.seconds + 1)
-            return await self.clone_message(msg)
+        except FloodWaitError:
+            # Não marcar como falha: clone_message espera e tenta de novo
+            raise
             
         except Exception as e:
             log.error(f"✗ Erro msg {msg.id}: {e}")
@@ -572,24 +1039,44 @@ class StreamingCloner:
     
     async def _clone_small_file(self, msg: Message, target_topic: int = None) -> bool:
         """Clone de arquivo pequeno (cabe em RAM)."""
-        import tempfile
-
         file_name = self._get_file_name(msg)
         file_size = self._get_file_size(msg)
 
         log.info(f"↓↑ Pequeno: {file_name} ({file_size/(1024*1024):.1f}MB)")
 
+        # Detectar tipo de mídia
+        is_video = msg.video is not None
+        is_photo = msg.photo is not None
+
+        # Sem watermark, thumbnail ou metadados de áudio/vídeo: direto em RAM, sem disco
+        needs_file = (
+            is_video or msg.audio or msg.voice or msg.video_note or msg.gif or
+            (WATERMARK_ENABLED and is_photo)
+        )
+        if not needs_file:
+            buffer = io.BytesIO()
+            buffer.name = file_name  # Telethon deduz mime/filename pelo nome
+            await self.client.download_media(msg, file=buffer)
+            buffer.seek(0)
+            await self.client.send_file(
+                TARGET_CHAT,
+                buffer,
+                caption=msg.text or "",
+                reply_to=target_topic,
+                force_document=False
+            )
+            log.info(f"✓ Pequeno (RAM): msg {msg.id}")
+            return True
+
         # Download para arquivo temporário com nome correto
-        tmp_dir = tempfile.gettempdir()
+        tmp_dir = TMP_DIR
         tmp_path = os.path.join(tmp_dir, file_name)
         wm_path = os.path.join(tmp_dir, f"wm_{file_name}")
+        thumb_path = None
 
         try:
             await self.client.download_media(msg, file=tmp_path)
 
-            # Detectar tipo de mídia
-            is_video = msg.video is not None
-            is_photo = msg.photo is not None
             supports_streaming = False
             upload_path = tmp_path  # Por padrão, enviar arquivo original
 
@@ -597,7 +1084,7 @@ class StreamingCloner:
             if WATERMARK_ENABLED:
                 if is_video:
                     log.info(f"🎬 Aplicando watermark em vídeo...")
-                    if add_watermark_video(tmp_path, wm_path):
+                    if await _run_media(add_watermark_video, tmp_path, wm_path, file_size):
                         upload_path = wm_path
                         log.info(f"✓ Watermark aplicada")
                     else:
@@ -605,7 +1092,7 @@ class StreamingCloner:
 
                 elif is_photo:
                     log.info(f"🖼 Aplicando watermark em foto...")
-                    if add_watermark_image(tmp_path, wm_path):
+                    if await _run_media(add_watermark_image, tmp_path, wm_path):
                         upload_path = wm_path
                         log.info(f"✓ Watermark aplicada")
                     else:
@@ -616,15 +1103,13 @@ class StreamingCloner:
             thumb_path = None
             if is_video:
                 # Extrair atributos do vídeo original
-                for attr in (msg.video.attributes if msg.video else []):
-                    if isinstance(attr, DocumentAttributeVideo):
-                        supports_streaming = getattr(attr, 'supports_streaming', True)
-                        video_attrs = attr
-                        break
+                video_attrs = _attr_map(msg.video).get(DocumentAttributeVideo) if msg.video else None
+                if video_attrs:
+                    supports_streaming = getattr(video_attrs, 'supports_streaming', True)
 
                 # Gerar thumbnail do vídeo processado (função robusta com múltiplos fallbacks)
                 thumb_path = os.path.join(tmp_dir, f"thumb_{file_name}.jpg")
-                if not generate_video_thumbnail(upload_path, thumb_path):
+                if not await _run_media(generate_video_thumbnail, upload_path, thumb_path):
                     thumb_path = None
 
             await self.client.send_file(
@@ -638,38 +1123,170 @@ class StreamingCloner:
                 attributes=[video_attrs] if video_attrs else None
             )
 
-            # Limpar thumbnail
-            if thumb_path and os.path.exists(thumb_path):
-                os.remove(thumb_path)
-
             log.info(f"✓ Pequeno: msg {msg.id}")
             return True
 
         finally:
             # Limpar arquivos temporários
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-            if os.path.exists(wm_path):
-                os.remove(wm_path)
+            await _cleanup(tmp_path, wm_path, thumb_path)
     
+    async def _watermark_video_piped(self, msg: Message, file_name: str,
+                                     thumb_path: str) -> tuple[StreamingUploader, bool] | None:
+        """
+        Watermark sem tocar o disco: iter_download → stdin do FFmpeg → stdout → upload.
+
+        A saída é MP4 fragmentado (dispensa seek). O mesmo FFmpeg grava em thumb_path
+        o thumbnail do vídeo já com a watermark. Retorna (uploader, thumbnail_ok),
+        ou None se o FFmpeg falhar.
+        """
+        encoder_args = await _run_media(_video_encoder_args)
+        # Saída com watermark dividida: vídeo para o pipe + um frame para o thumbnail
+        filter_complex = (
+            f'{WATERMARK_FILTER},split=2[vout][thumbsrc];'
+            f'[thumbsrc]scale={THUMB_WIDTH}:-1,thumbnail={THUMB_SCAN_FRAMES}[thumb]'
+        )
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, '-y', '-v', 'error',
+            '-i', 'pipe:0',
+            '-i', WATERMARK_PATH,
+            '-filter_complex', filter_complex,
+            '-map', '[vout]', '-map', '0:a:0?',
+            *encoder_args,
+            '-pix_fmt', 'yuv420p',
+            '-c:a', 'copy',
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-f', 'mp4', 'pipe:1',
+            '-map', '[thumb]', '-frames:v', '1', '-q:v', '2', thumb_path,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        uploader = StreamingUploader(self.client, None, file_name, self.upload_clients,
+                                     on_flood_wait=self._flush_checkpoint)
+
+        async def feed():
+            try:
+                async for chunk in self.client.iter_download(
+                    msg.media,
+                    chunk_size=CHUNK_SIZE,
+                    request_size=CHUNK_SIZE
+                ):
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # FFmpeg encerrou antes; o returncode diz se foi erro
+            finally:
+                proc.stdin.close()
+
+        async def upload_output() -> int:
+            # A última parte fica retida até o EOF para levar o total correto
+            part = 0
+            size = 0
+            held = None
+            while True:
+                try:
+                    data = await proc.stdout.readexactly(CHUNK_SIZE)
+                    eof = False
+                except asyncio.IncompleteReadError as e:
+                    data, eof = e.partial, True
+                if data:
+                    if held is not None:
+                        await uploader.upload_chunk(part, held)
+                        part += 1
+                    held = data
+                    size += len(data)
+                if eof:
+                    break
+            if held is not None:
+                uploader.set_file_size(size)
+                await uploader.upload_chunk(part, held)
+            return size
+
+        # gather não cancela as irmãs quando uma falha: tasks explícitas para o finally
+        tasks = [
+            asyncio.create_task(feed()),
+            asyncio.create_task(upload_output()),
+            asyncio.create_task(proc.stderr.read()),
+        ]
+        completed = False
+        try:
+            _, output_size, stderr = await asyncio.gather(*tasks)
+            await proc.wait()
+            await uploader.wait_completion()
+            completed = True
+        finally:
+            if not completed:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if not completed:
+                await uploader.cancel()
+
+        if proc.returncode != 0:
+            log.warning(f"FFmpeg (pipe) erro: {stderr.decode(errors='ignore')[-300:]}")
+            return None
+        if output_size < 1000:
+            log.warning(f"Saída do FFmpeg (pipe) muito pequena: {output_size} bytes")
+            return None
+        try:
+            thumb_ok = os.path.getsize(thumb_path) > 100  # tmpfs: stat sem I/O real
+        except OSError:
+            thumb_ok = False
+        return uploader, thumb_ok
+
     async def _clone_large_video_with_watermark(self, msg: Message, target_topic: int = None) -> bool:
         """
         Clone de vídeo grande COM watermark.
         
-        Requer download completo → processamento FFmpeg → upload.
+        Com WATERMARK_PIPE (e vídeo supports_streaming) tenta primeiro
+        download → FFmpeg → upload por pipes;
+        senão (ou se falhar) download completo → processamento FFmpeg → upload.
         Mais lento que streaming puro, mas aplica a marca d'água.
         
         Para vídeos muito grandes, isso pode demorar bastante.
         """
-        import tempfile
-
         file_name = self._get_file_name(msg)
         file_size = self._get_file_size(msg)
 
         log.info(f"🎬 Grande c/ watermark: {file_name} ({file_size/(1024*1024):.1f}MB)")
 
+        # Sem supports_streaming o moov costuma estar no fim do arquivo: o FFmpeg só
+        # o leria depois do pipe inteiro (download e partes desperdiçados antes do
+        # fallback). Esses vão direto para o caminho em disco.
+        video_attrs = _attr_map(msg.video).get(DocumentAttributeVideo) if msg.video else None
+        if WATERMARK_PIPE and video_attrs and video_attrs.supports_streaming:
+            start_time = time.time()
+            pipe_thumb_path = os.path.join(TMP_DIR, f"thumb_{file_name}.jpg")
+            try:
+                try:
+                    piped = await self._watermark_video_piped(msg, file_name, pipe_thumb_path)
+                except Exception as e:
+                    log.warning(f"⚠ Watermark via pipe falhou: {e}")
+                    piped = None
+                if piped:
+                    uploader, thumb_ok = piped
+                    # Thumbnail do vídeo processado (com watermark), como no caminho em disco
+                    thumb_input_file = await self.client.upload_file(pipe_thumb_path) if thumb_ok else None
+                    media = self._create_input_media(msg, uploader.get_input_file(), thumb=thumb_input_file)
+                    reply_to = self._reply_to(target_topic)
+                    await self.client(SendMediaRequest(
+                        peer=await self._get_target_peer(),
+                        media=media,
+                        message=msg.text or "",
+                        reply_to=reply_to
+                    ))
+                    total_time = time.time() - start_time
+                    log.info(f"✓ Grande c/ watermark (pipe): msg {msg.id} (total: {total_time:.1f}s)")
+                    return True
+            finally:
+                await _cleanup(pipe_thumb_path)
+            log.info("↺ Usando download completo para a watermark")
+
         # Diretório temporário com espaço suficiente
-        tmp_dir = tempfile.gettempdir()
+        tmp_dir = DISK_TMP_DIR
         tmp_path = os.path.join(tmp_dir, file_name)
         wm_path = os.path.join(tmp_dir, f"wm_{file_name}")
         thumb_path = os.path.join(tmp_dir, f"thumb_{file_name}.jpg")
@@ -688,7 +1305,7 @@ class StreamingCloner:
             wm_start = time.time()
             
             upload_path = tmp_path  # Por padrão, enviar original se watermark falhar
-            if add_watermark_video(tmp_path, wm_path):
+            if await _run_media(add_watermark_video, tmp_path, wm_path, file_size):
                 upload_path = wm_path
                 wm_time = time.time() - wm_start
                 log.info(f"✓ Watermark aplicada em {wm_time:.1f}s")
@@ -696,18 +1313,16 @@ class StreamingCloner:
                 log.warning(f"⚠ Falha na watermark, enviando original")
 
             # 3. Gerar thumbnail do vídeo processado
-            thumb_generated = generate_video_thumbnail(upload_path, thumb_path, is_preview=False)
+            thumb_generated = await _run_media(generate_video_thumbnail, upload_path, thumb_path, is_preview=False)
             if thumb_generated:
                 log.debug(f"✓ Thumbnail gerado")
 
             # 4. Extrair atributos do vídeo original
             supports_streaming = True
             video_attrs = None
-            for attr in (msg.video.attributes if msg.video else []):
-                if isinstance(attr, DocumentAttributeVideo):
-                    supports_streaming = getattr(attr, 'supports_streaming', True)
-                    video_attrs = attr
-                    break
+            video_attrs = _attr_map(msg.video).get(DocumentAttributeVideo) if msg.video else None
+            if video_attrs:
+                supports_streaming = getattr(video_attrs, 'supports_streaming', True)
 
             # 5. Upload do vídeo processado
             log.info(f"↑ Enviando vídeo processado...")
@@ -736,12 +1351,7 @@ class StreamingCloner:
 
         finally:
             # Limpar arquivos temporários
-            for path in [tmp_path, wm_path, thumb_path]:
-                if path and os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except Exception:
-                        pass
+            await _cleanup(tmp_path, wm_path, thumb_path)
     
     async def _clone_large_file_streaming(self, msg: Message, target_topic: int = None) -> bool:
         """
@@ -752,8 +1362,6 @@ class StreamingCloner:
         NOTA: Watermark não é aplicada em streaming puro por limitação técnica.
         Para vídeos que precisam de watermark, use _clone_large_file_with_watermark.
         """
-        import tempfile
-
         file_name = self._get_file_name(msg)
         file_size = self._get_file_size(msg)
         is_video = msg.video is not None
@@ -761,24 +1369,31 @@ class StreamingCloner:
         log.info(f"⚡ Streaming: {file_name} ({file_size/(1024*1024):.1f}MB)")
 
         # Criar uploader
-        uploader = StreamingUploader(self.client, file_size, file_name)
+        uploader = StreamingUploader(self.client, file_size, file_name, self.upload_clients,
+                                     on_flood_wait=self._flush_checkpoint)
 
         # Para vídeos: salvar primeiros chunks para gerar thumbnail
-        tmp_dir = tempfile.gettempdir()
+        tmp_dir = TMP_DIR
         video_preview_path = os.path.join(tmp_dir, f"preview_{file_name}") if is_video else None
         thumb_path = os.path.join(tmp_dir, f"thumb_{file_name}.jpg") if is_video else None
         preview_bytes = 0
-        preview_file = None
+        preview_chunks = None  # Referências aos chunks; gravados só quando o preview fecha
         thumb_generated = False
+        thumb_task = None  # Upload do thumbnail gerado, em paralelo com os chunks
         # 10MB para preview - vídeos 16:9 HD/4K podem ter keyframes esparsos
         PREVIEW_SIZE = 10 * 1024 * 1024
 
-        if is_video:
-            preview_file = open(video_preview_path, 'wb')
+        # Thumbnail já codificado pelo Telegram: dispensa preview em disco + ffmpeg
+        thumb_input_file = await self._upload_cached_thumb(msg) if is_video else None
+
+        if is_video and thumb_input_file is None:
+            preview_chunks = []
 
         # Stream download → upload em paralelo
         part_index = 0
         bytes_processed = 0
+        log_step = max(file_size // 10, 1)  # Log de progresso a cada 10%
+        next_log = log_step
         start_time = time.time()
 
         try:
@@ -791,46 +1406,44 @@ class StreamingCloner:
                 await uploader.upload_chunk(part_index, chunk)
 
                 # Salvar para preview (apenas primeiros chunks de vídeo)
-                if is_video and preview_file and preview_bytes < PREVIEW_SIZE:
-                    preview_file.write(chunk)
+                if preview_chunks is not None:
+                    preview_chunks.append(chunk)
                     preview_bytes += len(chunk)
 
                     # Quando temos dados suficientes, gerar thumbnail
-                    if preview_bytes >= PREVIEW_SIZE and not thumb_generated:
-                        preview_file.close()
-                        preview_file = None
+                    if preview_bytes >= PREVIEW_SIZE:
+                        chunks, preview_chunks = preview_chunks, None
                         log.debug(f"Gerando thumbnail de vídeo grande (preview={preview_bytes/(1024*1024):.1f}MB)...")
-                        # is_preview=True usa seeking preciso (mais lento, mas funciona com arquivos parciais)
-                        thumb_generated = generate_video_thumbnail(video_preview_path, thumb_path, is_preview=True)
+                        thumb_generated = await _run_media(generate_preview_thumbnail, chunks, video_preview_path, thumb_path)
                         if thumb_generated:
                             log.debug(f"✓ Thumbnail gerado para vídeo grande")
+                            thumb_task = asyncio.create_task(self.client.upload_file(thumb_path))
 
                 bytes_processed += len(chunk)
                 part_index += 1
 
                 # Log progresso a cada 10%
-                progress = bytes_processed / file_size * 100
-                if int(progress) % 10 == 0 and int(progress) > 0:
+                if bytes_processed >= next_log:
+                    next_log += log_step
+                    progress = bytes_processed / file_size * 100
                     elapsed = time.time() - start_time
                     speed = bytes_processed / elapsed / (1024 * 1024)
                     log.debug(f"  {progress:.0f}% ({speed:.1f} MB/s)")
 
-            # Fechar preview file se ainda aberto (vídeos muito pequenos em streaming)
-            if preview_file:
-                preview_file.close()
-                preview_file = None
-                # Tentar gerar thumbnail com o que temos
-                if is_video and not thumb_generated and preview_bytes > 0:
-                    thumb_generated = generate_video_thumbnail(video_preview_path, thumb_path, is_preview=True)
+            # Preview incompleto (vídeos muito pequenos em streaming): gerar com o que temos
+            if preview_chunks:
+                chunks, preview_chunks = preview_chunks, None
+                thumb_generated = await _run_media(generate_preview_thumbnail, chunks, video_preview_path, thumb_path)
+                if thumb_generated:
+                    thumb_task = asyncio.create_task(self.client.upload_file(thumb_path))
 
             # Aguardar uploads pendentes
             await uploader.wait_completion()
 
-            # Fazer upload do thumbnail se gerado
-            thumb_input_file = None
-            if thumb_generated and thumb_path and os.path.exists(thumb_path):
+            # Fallback: thumbnail gerado a partir do preview (já subindo em paralelo)
+            if thumb_task:
                 try:
-                    thumb_input_file = await self.client.upload_file(thumb_path)
+                    thumb_input_file = await thumb_task
                 except Exception as e:
                     log.warning(f"Falha no upload do thumbnail: {e}")
                     thumb_input_file = None
@@ -842,9 +1455,9 @@ class StreamingCloner:
             media = self._create_input_media(msg, input_file, thumb=thumb_input_file)
 
             # Enviar
-            reply_to = InputReplyToMessage(reply_to_msg_id=target_topic) if target_topic else None
+            reply_to = self._reply_to(target_topic)
             await self.client(SendMediaRequest(
-                peer=await self.client.get_input_entity(TARGET_CHAT),
+                peer=await self._get_target_peer(),
                 media=media,
                 message=msg.text or "",
                 reply_to=reply_to
@@ -858,47 +1471,75 @@ class StreamingCloner:
 
         finally:
             # Limpar arquivos temporários
-            if preview_file:
-                preview_file.close()
-            if video_preview_path and os.path.exists(video_preview_path):
-                os.remove(video_preview_path)
-            if thumb_path and os.path.exists(thumb_path):
-                os.remove(thumb_path)
+            if thumb_task and not thumb_task.done():
+                thumb_task.cancel()
+            await _cleanup(video_preview_path, thumb_path)
+    
+    async def _upload_cached_thumb(self, msg: Message):
+        """Reaproveita o thumbnail JPEG que o Telegram já mantém para o vídeo."""
+        sizes = [t for t in (msg.video.thumbs or []) if isinstance(t, PhotoSize)]
+        if not sizes:
+            return None
+        try:
+            thumb = max(sizes, key=lambda t: t.size)
+            thumb_bytes = await self.client.download_media(msg, thumb=thumb, file=bytes)
+            if thumb_bytes:
+                return await self.client.upload_file(thumb_bytes, file_name='thumb.jpg')
+        except Exception as e:
+            log.debug(f"Thumbnail do Telegram indisponível: {e}")
+        return None
     
     def _get_file_size(self, msg: Message) -> int:
-        """Retorna tamanho do arquivo."""
-        if msg.video:
-            return msg.video.size
-        if msg.document:
-            return msg.document.size
-        if msg.audio:
-            return msg.audio.size
-        if msg.voice:
-            return msg.voice.size
+        """Retorna tamanho do arquivo (memoizado na mensagem)."""
+        size = msg.__dict__.get('_sc_size')
+        if size is None:
+            size = msg.__dict__['_sc_size'] = self._compute_file_size(msg)
+        return size
+
+    def _compute_file_size(self, msg: Message) -> int:
+        # video/audio/voice são documentos: msg.document cobre todos sem as
+        # varreduras de atributos que cada uma dessas propriedades faz
+        doc = msg.document
+        if doc:
+            return doc.size
         if msg.photo:
-            return max(p.size for p in msg.photo.sizes if hasattr(p, 'size'))
+            # Telegram ordena os tamanhos do menor para o maior: o primeiro válido
+            # de trás para frente é o maior (stripped/cached ficam no início).
+            # PhotoSizeProgressive guarda os tamanhos das camadas; a última é a imagem completa
+            for p in reversed(msg.photo.sizes):
+                if isinstance(p, PhotoSize):
+                    return p.size
+                if isinstance(p, PhotoSizeProgressive) and p.sizes:
+                    return p.sizes[-1]
+            return 0
         return 0
     
     def _get_file_name(self, msg: Message) -> str:
-        """Retorna nome do arquivo."""
+        """Retorna nome do arquivo (memoizado na mensagem)."""
+        name = msg.__dict__.get('_sc_name')
+        if name is None:
+            name = msg.__dict__['_sc_name'] = self._compute_file_name(msg)
+        return name
+
+    def _compute_file_name(self, msg: Message) -> str:
         # Verificar documento
         if msg.document:
-            for attr in msg.document.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    return attr.file_name
+            name_attr = _attr_map(msg.document).get(DocumentAttributeFilename)
+            if name_attr:
+                return name_attr.file_name
         # Verificar vídeo
         if msg.video:
-            for attr in msg.video.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    return attr.file_name
+            name_attr = _attr_map(msg.video).get(DocumentAttributeFilename)
+            if name_attr:
+                return name_attr.file_name
             # Vídeos podem não ter filename, gerar com extensão correta
             ext = msg.video.mime_type.split('/')[-1] if msg.video.mime_type else 'mp4'
             return f"video_{msg.id}.{ext}"
         # Verificar áudio
         if msg.audio:
-            for attr in msg.audio.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    return attr.file_name
+            name_attr = _attr_map(msg.audio).get(DocumentAttributeFilename)
+            if name_attr:
+                return name_attr.file_name
             ext = msg.audio.mime_type.split('/')[-1] if msg.audio.mime_type else 'mp3'
             return f"audio_{msg.id}.{ext}"
         # Verificar foto
@@ -908,13 +1549,17 @@ class StreamingCloner:
     
     def _get_attributes(self, msg: Message, override_filename: str = None) -> list:
         """Retorna atributos do documento, opcionalmente substituindo o filename."""
-        attrs = []
-        if msg.document:
-            attrs = list(msg.document.attributes)
-        elif msg.video:
-            attrs = list(msg.video.attributes)
-        elif msg.audio:
-            attrs = list(msg.audio.attributes)
+        base = msg.__dict__.get('_sc_attrs')
+        if base is None:
+            base = []
+            if msg.document:
+                base = msg.document.attributes
+            elif msg.video:
+                base = msg.video.attributes
+            elif msg.audio:
+                base = msg.audio.attributes
+            msg.__dict__['_sc_attrs'] = base
+        attrs = list(base)
 
         # Se precisar sobrescrever o filename
         if override_filename:
@@ -960,9 +1605,36 @@ def load_checkpoint() -> int:
             return int(f.read().strip())
     return 0
 
-def save_checkpoint(msg_id: int):
-    with open(CHECKPOINT_FILE, 'w') as f:
-        f.write(str(msg_id))
+class CheckpointWriter:
+    """Grava o checkpoint em lote: no máximo uma escrita a cada CHECKPOINT_FLUSH_INTERVAL."""
+
+    def __init__(self):
+        self._pending: int | None = None
+        self._task = None
+
+    def save(self, msg_id: int):
+        self._pending = msg_id
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._delayed_write())
+
+    async def _delayed_write(self):
+        await asyncio.sleep(CHECKPOINT_FLUSH_INTERVAL)
+        self._write()
+
+    def _write(self):
+        if self._pending is None:
+            return
+        tmp_path = CHECKPOINT_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(self._pending))
+        os.replace(tmp_path, CHECKPOINT_FILE)
+        self._pending = None
+
+    async def flush(self):
+        """Grava imediatamente o checkpoint pendente."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._write()
 
 
 async def main():
@@ -981,8 +1653,12 @@ async def main():
     
     stats = {'ok': 0, 'fail': 0, 'bytes': 0}
     start_time = time.time()
+    checkpoint = CheckpointWriter()
     
-    async with TelegramClient('cloner', API_ID, API_HASH) as client:
+    # Sem loop de updates (o clone não escuta eventos); FloodWait curto
+    # (< flood_sleep_threshold) é dormido pelo próprio Telethon
+    async with TelegramClient('cloner', API_ID, API_HASH, receive_updates=False,
+                              flood_sleep_threshold=60, connection_retries=10) as client:
         
         # Inicializar Topic Manager
         topic_manager = None
@@ -993,44 +1669,51 @@ async def main():
         elif AUTO_CREATE_TOPICS and not FORUM_SUPPORT:
             log.warning("AUTO_CREATE_TOPICS configurado mas Forum não suportado - ignorando")
             
-        cloner = StreamingCloner(client, topic_manager=topic_manager)
+        upload_pool = UploadPool(client)
+        await upload_pool.start(UPLOAD_CONNECTIONS)
+        cloner = StreamingCloner(client, topic_manager=topic_manager, upload_pool=upload_pool,
+                                 checkpoint=checkpoint)
         
         log.info("Conectado! Buscando mensagens...")
         
-        async for msg in client.iter_messages(
+        # Próximas páginas do histórico chegam enquanto a mensagem atual é clonada
+        messages = _prefetch(_iter_messages_resumable(
+            client,
             SOURCE_CHAT,
             min_id=last_id,
-            reverse=True
-        ):
-            # Filtrar por tópico
-            if SOURCE_TOPIC:
-                if getattr(msg, 'reply_to_msg_id', None) != SOURCE_TOPIC:
-                    if getattr(msg, 'reply_to', None):
-                        if getattr(msg.reply_to, 'reply_to_top_id', None) != SOURCE_TOPIC:
-                            continue
-                    else:
-                        continue
-            
-            success = await cloner.clone_message(msg)
+            reply_to=SOURCE_TOPIC or None,  # Filtro de tópico no servidor (GetReplies)
+            wait_time=0  # Sem limit o Telethon dorme 1s a cada 100 msgs; FloodWait longo reabre a busca
+        ), PREFETCH_MESSAGES)
+        
+        try:
+            async for msg in messages:
+                success = await cloner.clone_message(msg)
             
-            if success:
-                stats['ok'] += 1
-                stats['bytes'] += cloner._get_file_size(msg) or 0
-            else:
-                stats['fail'] += 1
+                if success:
+                    stats['ok'] += 1
+                    stats['bytes'] += cloner._get_file_size(msg) or 0
+                else:
+                    stats['fail'] += 1
             
-            save_checkpoint(msg.id)
+                checkpoint.save(msg.id)
             
-            # Log a cada 10
-            total = stats['ok'] + stats['fail']
-            if total % 10 == 0:
-                elapsed = (time.time() - start_time) / 60
-                rate = total / elapsed if elapsed > 0 else 0
-                gb = stats['bytes'] / (1024**3)
-                log.info(
-                    f"Progresso: {stats['ok']} ok | "
-                    f"{rate:.1f} msg/min | {gb:.2f} GB"
-                )
+                # Log a cada 10
+                total = stats['ok'] + stats['fail']
+                if total % 10 == 0:
+                    elapsed = (time.time() - start_time) / 60
+                    rate = total / elapsed if elapsed > 0 else 0
+                    gb = stats['bytes'] / (1024**3)
+                    log.info(
+                        f"Progresso: {stats['ok']} ok | "
+                        f"{rate:.1f} msg/min | {gb:.2f} GB"
+                    )
+        finally:
+            await messages.aclose()
+            # Gravar checkpoint e mapeamento de tópicos pendentes
+            await checkpoint.flush()
+            if topic_manager:
+                await topic_manager.flush()
+            await upload_pool.close()
     
     elapsed = (time.time() - start_time) / 60
     log.info("=" * 60)
@@ -1043,4 +1726,6 @@ async def main():
 
 
 if __name__ == "__main__":
+    if UVLOOP_SUPPORT:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
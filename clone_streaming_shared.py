@@ -12,20 +12,30 @@ Usa:
 """
 
 import asyncio
+import functools
 import os
 import time
 import logging
 import hashlib
-import random
+import fcntl
+import io
+import json
+import secrets
+import shutil
+import tempfile
 import sqlite3
+import threading
+from collections import OrderedDict
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from typing import AsyncGenerator, BinaryIO
-from contextlib import contextmanager
 
 from telethon import TelegramClient
+from telethon.sessions import StringSession
 from telethon.tl.types import (
     Message, DocumentAttributeVideo, DocumentAttributeFilename,
-    InputFileBig, InputMediaUploadedDocument, InputReplyToMessage
+    InputFileBig, InputMediaUploadedDocument, InputReplyToMessage, PhotoSize,
+    PhotoSizeProgressive
 )
 from telethon.tl.functions.upload import SaveBigFilePartRequest
 from telethon.tl.functions.messages import SendMediaRequest
@@ -40,6 +50,13 @@ except ImportError:
     FORUM_SUPPORT = False
     logging.warning("Forum Topics não suportado nesta versão do Telethon")
 
+# uvloop (event loop em libuv) - opcional, mais rápido com muitos chunks em voo
+try:
+    import uvloop
+    UVLOOP_SUPPORT = True
+except ImportError:
+    UVLOOP_SUPPORT = False
+
 # ============================================================
 # CONFIGURAÇÃO
 # ============================================================
@@ -53,6 +70,98 @@ TARGET_CHAT = int(os.environ['TARGET_CHAT'])
 # Session name único para esta instância
 SESSION_NAME = os.environ.get('SESSION_NAME', 'session')
 
+# IDs aleatórios de 63 bits com sinal (random_id / file_id do MTProto)
+def _random_id() -> int:
+    return secrets.randbits(63) - (1 << 62)
+
+
+def _attr_map(doc) -> dict:
+    """Índice {tipo: atributo} do documento, montado uma vez e guardado nele."""
+    m = doc.__dict__.get('_sc_attr_map')
+    if m is None:
+        m = doc.__dict__['_sc_attr_map'] = {type(a): a for a in doc.attributes}
+    return m
+
+
+def _remove_quiet(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_db_files(path: str):
+    """Remove um banco SQLite junto com seus -wal/-shm."""
+    for p in (path, f"{path}-wal", f"{path}-shm"):
+        _remove_quiet(p)
+
+
+def _newer_on_disk(disk_path: str, copy_path: str) -> bool:
+    """True se copy_path não existe ou o banco em disk_path (ou seu WAL) foi alterado depois."""
+    def mtime(path: str) -> float:
+        return max((os.path.getmtime(p) for p in (path, f"{path}-wal") if os.path.exists(p)),
+                   default=0.0)
+    if not os.path.exists(copy_path):
+        return True
+    return mtime(disk_path) > mtime(copy_path)
+
+
+async def _cleanup(*paths):
+    """Remove temporários em paralelo no executor, fora do event loop."""
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(
+        *(loop.run_in_executor(None, _remove_quiet, p) for p in paths if p),
+        return_exceptions=True
+    )
+
+
+_PREFETCH_END = object()
+
+
+async def _prefetch(source, maxsize: int) -> AsyncGenerator:
+    """
+    Consome um async iterator em background, até maxsize itens à frente.
+    A busca da próxima página (iter_messages) sobrepõe o clone da atual.
+    """
+    queue = asyncio.Queue(maxsize)
+
+    async def produce():
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_PREFETCH_END)
+        except Exception as e:
+            await queue.put(e)  # Repassado ao consumidor
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _PREFETCH_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+
+async def _iter_messages_resumable(client, chat, min_id: int, **kwargs) -> AsyncGenerator:
+    """
+    iter_messages (reverse=True) que sobrevive a FloodWait longo: o Telethon só
+    dorme sozinho até flood_sleep_threshold; acima disso espera aqui e reabre a
+    iteração a partir do último id entregue.
+    """
+    while True:
+        try:
+            async for msg in client.iter_messages(chat, min_id=min_id, reverse=True, **kwargs):
+                min_id = msg.id
+                yield msg
+            return
+        except FloodWaitError as e:
+            log.warning(f"FloodWait ao buscar mensagens: {e.seconds}s (retomando após {min_id})")
+            await asyncio.sleep(e.seconds + 1)
+
 # Helper para converter topic ID (trata string vazia)
 def _parse_topic(val):
     if not val or val.strip() == '':
@@ -67,14 +176,32 @@ AUTO_CREATE_TOPICS = os.environ.get('AUTO_CREATE_TOPICS', 'true').lower() == 'tr
 
 # Topic mapping file (para persistência)
 TOPIC_MAP_FILE = 'topic_map.json'
+TOPIC_MAP_LOG = 'topic_map.log'  # Criações de tópico (append-only), compactadas no JSON
+TOPIC_MAP_SAVE_DELAY = 1.0  # Segundos para agrupar escritas do topic_map
+FORUM_TOPICS_PAGE = 100     # Tópicos por GetForumTopicsRequest (máximo da API)
 
 # Streaming config
 CHUNK_SIZE = 512 * 1024  # 512KB por chunk (máximo MTProto)
 PARALLEL_UPLOADS = 10     # Chunks em paralelo no upload
 BUFFER_CHUNKS = 20        # Chunks em buffer (~10MB)
+PREFETCH_MESSAGES = 500   # Mensagens buscadas à frente do clone
+# Conexões MTProto para upload de partes (mesma auth_key; 1 = só o client principal)
+UPLOAD_CONNECTIONS = int(os.environ.get('UPLOAD_CONNECTIONS', '1'))
+# Limite global de partes em voo (somado entre todos os uploads simultâneos)
+_UPLOAD_SEMAPHORE = asyncio.BoundedSemaphore(PARALLEL_UPLOADS)
 
 # Rate limit - Telegram permite ~30-50 msg/min
 MIN_INTERVAL = 1.3  # ~46 msg/min (seguro dentro do limite)
+RATE_LIMIT_BURST = 5  # Mensagens permitidas em rajada (token bucket)
+
+# Temporários pequenos (mídia <10MB, previews, thumbnails) em tmpfs quando
+# disponível - evita writeback em disco. Vídeos grandes com watermark
+# continuam no tempdir em disco (DISK_TMP_DIR) para não consumir RAM.
+DISK_TMP_DIR = tempfile.gettempdir()
+TMP_DIR = os.environ.get('TMP_DIR') or (
+    '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK)
+    else DISK_TMP_DIR
+)
 
 # ============================================================
 # CHECKPOINT SQLITE COMPARTILHADO
@@ -84,6 +211,24 @@ MIN_INTERVAL = 1.3  # ~46 msg/min (seguro dentro do limite)
 # Usar caminho relativo para ../shared/ ou variável de ambiente
 SHARED_DB_PATH = os.environ.get('SHARED_DB_PATH', '../shared/checkpoint.db')
 
+# Escritas de status (done/failed) em lote: uma transação a cada intervalo
+WRITE_BATCH_MAX = 500
+WRITE_BATCH_INTERVAL = 0.2  # Segundos
+# Mensagens entre recargas do conjunto de IDs já concluídos (outras sessões avançam)
+DONE_IDS_REFRESH = 500
+STALE_LOCK_BATCH = 1000  # Locks liberados por UPDATE em cleanup_stale_locks
+DONE_CACHE_MAX = 10_000  # Entradas no LRU de is_processed
+# Mensagens revistas abaixo do prefixo concluído no resume (done_ids filtram)
+RESUME_SAFETY_MARGIN = 100
+
+# Opcional: banco ativo em tmpfs (/dev/shm) com snapshot periódico para SHARED_DB_PATH.
+# Sessões na mesma máquina compartilham a cópia em RAM e todas devem usar o mesmo
+# modo. Queda de energia perde até SHARED_DB_SNAPSHOT_INTERVAL segundos de progresso.
+# A cópia em RAM persiste entre execuções (até o reboot) se uma sessão cair; a última
+# sessão a encerrar a remove, e ela é recarregada do disco se o disco for mais novo.
+SHARED_DB_TMPFS = os.environ.get('SHARED_DB_TMPFS', '') == '1'
+SHARED_DB_SNAPSHOT_INTERVAL = 60  # Segundos
+
 class SharedCheckpoint:
     """
     Checkpoint compartilhado usando SQLite.
@@ -94,171 +239,373 @@ class SharedCheckpoint:
     - 'processing': sendo processada (lock)
     - 'done': concluída
     - 'failed': falhou
+
+    mark_done/mark_failed vão para uma fila gravada em lote por uma task de
+    fundo (uma transação por lote); flush() aguarda a fila esvaziar.
     """
     
     def __init__(self, db_path: str = SHARED_DB_PATH):
         self.db_path = os.path.abspath(db_path)
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.disk_path = None  # Destino dos snapshots quando o banco ativo está em tmpfs
+        self._tmpfs_lock = None  # flock compartilhado enquanto a sessão usa a cópia em RAM
+        if SHARED_DB_TMPFS and os.path.isdir('/dev/shm'):
+            self.disk_path = self.db_path
+            self.db_path = self._stage_in_tmpfs(self.disk_path)
+        self._tls = threading.local()
+        # LRU de (source_chat, msg_id) já concluídos: 'done' é final, nunca precisa
+        # invalidar. Lock porque is_processed roda no executor e mark_done no loop.
+        self._done_cache: OrderedDict[tuple[int, int], None] = OrderedDict()
+        self._done_lock = threading.Lock()
         self._init_db()
+
+        # Write-behind: thread própria (e portanto conexão própria) para as escritas em lote
+        self._write_q: asyncio.Queue = asyncio.Queue()
+        self._writer_task = None
+        self._snapshot_task = None
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        # Leituras/locks chamados do código async também saem do event loop
+        self._reader_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-reader')
     
+    def _stage_in_tmpfs(self, disk_path: str) -> str:
+        """
+        Copia o banco do disco para /dev/shm (uma vez por máquina) e retorna o caminho.
+
+        Cada sessão segura um flock compartilhado em <cópia>.lock. Quem consegue o
+        exclusivo é a única sessão ativa: só então a cópia pode ser refeita a partir
+        do disco (se o disco for mais novo) ou removida no encerramento.
+        """
+        digest = hashlib.sha1(disk_path.encode()).hexdigest()[:12]
+        shm_path = f"/dev/shm/clone_checkpoint_{digest}.db"
+        lock = open(f"{shm_path}.lock", 'a')
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Outras sessões ativas: a cópia em RAM é a versão viva
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                if os.path.exists(shm_path):
+                    break
+                fcntl.flock(lock, fcntl.LOCK_UN)  # Removida pela última sessão; recomeçar
+                continue
+            if _newer_on_disk(disk_path, shm_path):
+                if os.path.exists(shm_path):
+                    log.warning(f"Checkpoint em disco mais novo que {shm_path}; recarregando do disco")
+                _remove_db_files(shm_path)
+                part_path = f"{shm_path}.{os.getpid()}"
+                dst = sqlite3.connect(part_path)
+                if os.path.exists(disk_path):
+                    src = sqlite3.connect(disk_path)
+                    src.backup(dst)  # Lê através do WAL, cópia consistente
+                    src.close()
+                dst.close()
+                os.replace(part_path, shm_path)
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            break
+        self._tmpfs_lock = lock
+        log.info(f"Checkpoint em tmpfs: {shm_path} (snapshot em {disk_path})")
+        return shm_path
+
+    def _release_tmpfs(self):
+        """Remove a cópia em RAM se esta é a última sessão usando-a (já com snapshot final)."""
+        try:
+            fcntl.flock(self._tmpfs_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # Outra sessão segue ativa e fará o snapshot final dela
+        _remove_db_files(self.db_path)
+        fcntl.flock(self._tmpfs_lock, fcntl.LOCK_UN)
+        self._tmpfs_lock.close()
+        self._tmpfs_lock = None
+
+    def _snapshot(self):
+        """Grava uma cópia consistente do banco em tmpfs no disco (atômica)."""
+        tmp_path = f"{self.disk_path}.snapshot-{os.getpid()}"
+        _remove_quiet(tmp_path)
+        self._get_conn().execute('VACUUM INTO ?', (tmp_path,))
+        # WAL antigo ao lado do arquivo de disco não pertence ao snapshot novo
+        _remove_quiet(f"{self.disk_path}-wal")
+        _remove_quiet(f"{self.disk_path}-shm")
+        os.replace(tmp_path, self.disk_path)
+
+    async def _snapshot_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(SHARED_DB_SNAPSHOT_INTERVAL)
+            try:
+                await loop.run_in_executor(self._writer_executor, self._snapshot)
+            except Exception as e:
+                log.error(f"Erro no snapshot do checkpoint: {e}")
+
     def _init_db(self):
         """Inicializa banco de dados."""
-        with self._get_conn() as conn:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    source_chat INTEGER NOT NULL,
-                    msg_id INTEGER NOT NULL,
-                    status TEXT DEFAULT NULL,
-                    session TEXT DEFAULT NULL,
-                    processed_at TIMESTAMP DEFAULT NULL,
-                    target_msg_id INTEGER DEFAULT NULL,
-                    PRIMARY KEY (source_chat, msg_id)
-                )
-            ''')
-            conn.execute('''
-                CREATE INDEX IF NOT EXISTS idx_status 
-                ON messages(source_chat, status)
-            ''')
-            conn.commit()
+        conn = self._get_conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                source_chat INTEGER NOT NULL,
+                msg_id INTEGER NOT NULL,
+                status TEXT DEFAULT NULL,
+                session TEXT DEFAULT NULL,
+                processed_at TIMESTAMP DEFAULT NULL,
+                target_msg_id INTEGER DEFAULT NULL,
+                scope INTEGER DEFAULT NULL,
+                PRIMARY KEY (source_chat, msg_id)
+            )
+        ''')
+        # Bancos antigos: scope = tópico varrido quando a linha foi criada (0 = chat inteiro)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+        if 'scope' not in columns:
+            conn.execute('ALTER TABLE messages ADD COLUMN scope INTEGER DEFAULT NULL')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_scope
+            ON messages(source_chat, scope, msg_id)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_status 
+            ON messages(source_chat, status)
+        ''')
+        # Índice parcial: só as linhas em 'processing' (poucas) entram
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_processing_age
+            ON messages(processed_at) WHERE status = 'processing'
+        ''')
     
-    @contextmanager
-    def _get_conn(self):
-        """Conexão com timeout e WAL mode para concorrência."""
-        conn = sqlite3.connect(
-            self.db_path, 
-            timeout=30.0,
-            isolation_level='IMMEDIATE'
-        )
-        conn.execute('PRAGMA journal_mode=WAL')
-        conn.execute('PRAGMA busy_timeout=30000')
-        try:
-            yield conn
-        finally:
-            conn.close()
+    def _get_conn(self) -> sqlite3.Connection:
+        """Conexão persistente por thread (autocommit, WAL); PRAGMAs só na criação."""
+        conn = getattr(self._tls, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=30.0,
+                isolation_level=None,
+                check_same_thread=False
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA cache_size=-65536')       # 64MB
+            conn.execute('PRAGMA mmap_size=268435456')     # 256MB
+            conn.execute('PRAGMA wal_autocheckpoint=1000')
+            self._tls.conn = conn
+        return conn
     
-    def try_lock_message(self, source_chat: int, msg_id: int, session: str) -> bool:
+    def try_lock_message(self, source_chat: int, msg_id: int, session: str,
+                         scope: int = 0) -> bool:
         """
         Tenta fazer lock de uma mensagem para processamento.
-        
+        scope é o tópico varrido pela sessão (0 = chat inteiro), usado por get_resume_id.
+
         Returns:
             True se conseguiu o lock (pode processar)
             False se já está em processamento ou concluída
         """
-        with self._get_conn() as conn:
-            try:
-                # Tentar inserir novo registro com status 'processing'
-                cursor = conn.execute('''
-                    INSERT INTO messages (source_chat, msg_id, status, session)
-                    VALUES (?, ?, 'processing', ?)
-                    ON CONFLICT(source_chat, msg_id) DO UPDATE SET
-                        status = CASE 
-                            WHEN messages.status IS NULL THEN 'processing'
-                            WHEN messages.status = 'failed' THEN 'processing'
-                            ELSE messages.status
-                        END,
-                        session = CASE
-                            WHEN messages.status IS NULL THEN excluded.session
-                            WHEN messages.status = 'failed' THEN excluded.session
-                            ELSE messages.session
-                        END
-                    WHERE messages.status IS NULL OR messages.status = 'failed'
-                ''', (source_chat, msg_id, session))
-                
-                conn.commit()
-                
-                # Verificar se realmente conseguimos o lock
-                cursor = conn.execute('''
-                    SELECT status, session FROM messages 
-                    WHERE source_chat = ? AND msg_id = ?
-                ''', (source_chat, msg_id))
-                
-                row = cursor.fetchone()
-                if row:
-                    status, locked_session = row
-                    return status == 'processing' and locked_session == session
-                
-                return False
-                
-            except sqlite3.IntegrityError:
-                # Já existe, verificar status
-                return False
+        conn = self._get_conn()
+        # Caminho comum: mensagem nova, um INSERT e pronto
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO messages (source_chat, msg_id, status, session, processed_at, scope)
+            VALUES (?, ?, 'processing', ?, datetime('now'), ?)
+        ''', (source_chat, msg_id, session, scope))
+        if cursor.rowcount == 1:
+            return True
+
+        # Já existe: assumir só se livre, falhou, ou já é nosso (retry após FloodWait)
+        cursor = conn.execute('''
+            UPDATE messages
+            SET status = 'processing', session = ?, processed_at = datetime('now')
+            WHERE source_chat = ? AND msg_id = ?
+            AND (status IS NULL OR status = 'failed'
+                 OR (status = 'processing' AND session = ?))
+        ''', (session, source_chat, msg_id, session))
+        return cursor.rowcount == 1
+
+    async def _in_thread(self, func, *args):
+        # busy_timeout pode esperar até 30s: nunca no thread do event loop
+        return await asyncio.get_running_loop().run_in_executor(self._reader_executor, func, *args)
+
+    async def try_lock_message_async(self, source_chat: int, msg_id: int, session: str,
+                                     scope: int = 0) -> bool:
+        return await self._in_thread(self.try_lock_message, source_chat, msg_id, session, scope)
+
+    async def is_processed_async(self, source_chat: int, msg_id: int) -> bool:
+        return await self._in_thread(self.is_processed, source_chat, msg_id)
+
+    async def load_done_ids_async(self, source_chat: int, min_id: int = 0) -> set[int]:
+        return await self._in_thread(self.load_done_ids, source_chat, min_id)
     
     def mark_done(self, source_chat: int, msg_id: int, target_msg_id: int = None):
         """Marca mensagem como processada com sucesso."""
-        with self._get_conn() as conn:
-            conn.execute('''
-                UPDATE messages 
-                SET status = 'done', 
-                    processed_at = datetime('now'),
-                    target_msg_id = ?
-                WHERE source_chat = ? AND msg_id = ?
-            ''', (target_msg_id, source_chat, msg_id))
-            conn.commit()
+        self._remember_done((source_chat, msg_id))
+        self._enqueue_write(('done', target_msg_id, source_chat, msg_id))
     
     def mark_failed(self, source_chat: int, msg_id: int):
         """Marca mensagem como falha (pode ser reprocessada)."""
-        with self._get_conn() as conn:
-            conn.execute('''
-                UPDATE messages 
-                SET status = 'failed', processed_at = datetime('now')
+        self._enqueue_write(('failed', None, source_chat, msg_id))
+
+    def _enqueue_write(self, row: tuple):
+        self._write_q.put_nowait(row)
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._writer_loop())
+        if self.disk_path and (self._snapshot_task is None or self._snapshot_task.done()):
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+
+    async def _writer_loop(self):
+        """Agrupa até WRITE_BATCH_MAX updates (ou WRITE_BATCH_INTERVAL) por transação."""
+        loop = asyncio.get_running_loop()
+        while True:
+            rows = [await self._write_q.get()]
+            deadline = loop.time() + WRITE_BATCH_INTERVAL
+            while len(rows) < WRITE_BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(self._write_q.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await loop.run_in_executor(self._writer_executor, self._write_batch, rows)
+            except Exception as e:
+                log.error(f"Erro gravando checkpoint ({len(rows)} msgs): {e}")
+            finally:
+                for _ in rows:
+                    self._write_q.task_done()
+
+    def _write_batch(self, rows: list):
+        conn = self._get_conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('''
+                UPDATE messages
+                SET status = ?,
+                    processed_at = datetime('now'),
+                    target_msg_id = COALESCE(?, target_msg_id)
                 WHERE source_chat = ? AND msg_id = ?
-            ''', (source_chat, msg_id))
-            conn.commit()
+            ''', rows)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    async def flush(self):
+        """
+        Aguarda a gravação de todos os status pendentes (usar ao encerrar).
+        Em tmpfs grava o snapshot final e, se for a última sessão, remove a cópia em RAM.
+        """
+        await self._write_q.join()
+        if self.disk_path:
+            if self._snapshot_task and not self._snapshot_task.done():
+                self._snapshot_task.cancel()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._writer_executor, self._snapshot)
+            if self._tmpfs_lock:
+                await loop.run_in_executor(self._writer_executor, self._release_tmpfs)
+    
+    def _remember_done(self, key: tuple[int, int]):
+        with self._done_lock:
+            self._done_cache[key] = None
+            self._done_cache.move_to_end(key)
+            if len(self._done_cache) > DONE_CACHE_MAX:
+                self._done_cache.popitem(last=False)
     
     def is_processed(self, source_chat: int, msg_id: int) -> bool:
         """Verifica se mensagem já foi processada."""
-        with self._get_conn() as conn:
-            cursor = conn.execute('''
-                SELECT status FROM messages 
-                WHERE source_chat = ? AND msg_id = ?
-            ''', (source_chat, msg_id))
-            row = cursor.fetchone()
-            return row is not None and row[0] == 'done'
+        key = (source_chat, msg_id)
+        with self._done_lock:
+            if key in self._done_cache:
+                self._done_cache.move_to_end(key)
+                return True
+        conn = self._get_conn()
+        cursor = conn.execute('''
+            SELECT status FROM messages 
+            WHERE source_chat = ? AND msg_id = ?
+        ''', (source_chat, msg_id))
+        row = cursor.fetchone()
+        if row is not None and row[0] == 'done':
+            self._remember_done(key)
+            return True
+        return False
+    
+    def load_done_ids(self, source_chat: int, min_id: int = 0) -> set[int]:
+        """Retorna os msg_id concluídos a partir de min_id (um SELECT em vez de um por mensagem)."""
+        conn = self._get_conn()
+        cursor = conn.execute('''
+            SELECT msg_id FROM messages
+            WHERE source_chat = ? AND status = 'done' AND msg_id >= ?
+        ''', (source_chat, min_id))
+        return {row[0] for row in cursor}
+    
+    def get_resume_id(self, source_chat: int, scope: int = 0) -> int:
+        """
+        msg_id K tal que tudo até K já foi concluído (min_id para iter_messages),
+        menos RESUME_SAFETY_MARGIN.
+        Toda mensagem vista passa por try_lock_message, mas só até onde uma varredura
+        do mesmo scope chegou: linhas criadas ao varrer outro tópico não cobrem este.
+        Abaixo desse limite os buracos só podem ser linhas 'processing'/'failed'.
+        """
+        conn = self._get_conn()
+        cursor = conn.execute('''
+            SELECT
+                (SELECT MAX(msg_id) FROM messages WHERE source_chat = ? AND scope = ?),
+                (SELECT MIN(msg_id) FROM messages
+                 WHERE source_chat = ? AND status IS NOT 'done') - 1
+        ''', (source_chat, scope, source_chat))
+        scanned, first_gap = cursor.fetchone()
+        if not scanned:
+            return 0  # Nenhuma varredura deste scope registrada (ou banco antigo)
+        resume_id = scanned if first_gap is None else min(scanned, first_gap)
+        return max(resume_id - RESUME_SAFETY_MARGIN, 0)
     
     def get_last_processed(self, source_chat: int) -> int:
         """Retorna o último msg_id processado com sucesso."""
-        with self._get_conn() as conn:
-            cursor = conn.execute('''
-                SELECT MAX(msg_id) FROM messages 
-                WHERE source_chat = ? AND status = 'done'
-            ''', (source_chat,))
-            row = cursor.fetchone()
-            return row[0] if row and row[0] else 0
+        conn = self._get_conn()
+        cursor = conn.execute('''
+            SELECT MAX(msg_id) FROM messages 
+            WHERE source_chat = ? AND status = 'done'
+        ''', (source_chat,))
+        row = cursor.fetchone()
+        return row[0] if row and row[0] else 0
     
     def get_stats(self, source_chat: int = None) -> dict:
         """Retorna estatísticas do checkpoint."""
-        with self._get_conn() as conn:
-            if source_chat:
-                cursor = conn.execute('''
-                    SELECT status, COUNT(*) FROM messages 
-                    WHERE source_chat = ?
-                    GROUP BY status
-                ''', (source_chat,))
-            else:
-                cursor = conn.execute('''
-                    SELECT status, COUNT(*) FROM messages 
-                    GROUP BY status
-                ''')
-            
-            stats = {'done': 0, 'processing': 0, 'failed': 0}
-            for row in cursor:
-                if row[0]:
-                    stats[row[0]] = row[1]
-            return stats
+        conn = self._get_conn()
+        if source_chat:
+            cursor = conn.execute('''
+                SELECT status, COUNT(*) FROM messages 
+                WHERE source_chat = ?
+                GROUP BY status
+            ''', (source_chat,))
+        else:
+            cursor = conn.execute('''
+                SELECT status, COUNT(*) FROM messages 
+                GROUP BY status
+            ''')
+        
+        stats = {'done': 0, 'processing': 0, 'failed': 0}
+        for row in cursor:
+            if row[0]:
+                stats[row[0]] = row[1]
+        return stats
     
     def cleanup_stale_locks(self, max_age_minutes: int = 30):
         """
         Limpa locks antigos (sessões que morreram).
-        Mensagens em 'processing' há mais de X minutos voltam para NULL.
+        Mensagens em 'processing' há mais de X minutos voltam para 'failed'.
+        Em lotes de STALE_LOCK_BATCH para não segurar o lock de escrita.
         """
-        with self._get_conn() as conn:
-            conn.execute('''
+        conn = self._get_conn()
+        while True:
+            cursor = conn.execute('''
                 UPDATE messages 
                 SET status = 'failed', session = NULL
-                WHERE status = 'processing' 
-                AND processed_at < datetime('now', ?)
-            ''', (f'-{max_age_minutes} minutes',))
-            conn.commit()
+                WHERE rowid IN (
+                    SELECT rowid FROM messages
+                    WHERE status = 'processing'
+                    AND processed_at < datetime('now', ?)
+                    LIMIT ?
+                )
+            ''', (f'-{max_age_minutes} minutes', STALE_LOCK_BATCH))
+            if cursor.rowcount < STALE_LOCK_BATCH:
+                break
 
 
 # Watermark
@@ -269,6 +616,11 @@ WATERMARK_ENABLED = os.path.exists(WATERMARK_PATH)
 # Default: 50MB. Use 0 para desabilitar limite (watermark em todos).
 WATERMARK_MAX_SIZE_MB = int(os.environ.get('WATERMARK_MAX_SIZE_MB', '50'))
 WATERMARK_MAX_SIZE = WATERMARK_MAX_SIZE_MB * 1024 * 1024  # Converter para bytes
+# Vídeos grandes: download → FFmpeg → upload via pipes, sem o arquivo em disco.
+# Se o FFmpeg não conseguir ler a origem via pipe, cai no fluxo em disco.
+WATERMARK_PIPE = os.environ.get('WATERMARK_PIPE', 'true').lower() == 'true'
+# Encode H.264 na GPU (NVENC) quando houver uma utilizável; senão libx264
+VIDEO_HWENC = os.environ.get('VIDEO_HWENC', 'true').lower() == 'true'
 
 # ============================================================
 # LOGGING
@@ -291,34 +643,104 @@ log = logging.getLogger(__name__)
 import subprocess
 from PIL import Image
 
-def add_watermark_video(input_path: str, output_path: str) -> bool:
+# PyAV - opcional, extrai thumbnails em processo (sem fork/exec de ffmpeg)
+try:
+    import av
+    PYAV_SUPPORT = True
+except ImportError:
+    PYAV_SUPPORT = False
+
+# Binário do FFmpeg resolvido uma vez (evita busca no PATH a cada chamada)
+FFMPEG_BIN = shutil.which('ffmpeg') or 'ffmpeg'
+
+# FFmpeg/Pillow são bloqueantes: rodam em threads para o event loop continuar
+# atendendo uploads. O trabalho pesado fica no subprocesso/C (sem GIL).
+_MEDIA_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='media')
+
+async def _run_media(func, *args, **kwargs):
+    call = functools.partial(func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_MEDIA_EXECUTOR, call)
+
+# Filtro complexo para 2 watermarks em diagonal.
+# A watermark é convertida para yuva420p uma única vez (antes do split) e o
+# overlay mistura direto em yuv420, que já é o formato de saída do libx264 -
+# evita as conversões RGB/YUV por frame.
+WATERMARK_FILTER = (
+    '[1:v]scale=iw*0.225:-1,format=yuva420p,split=2[wm1][wm2];'
+    '[0:v][wm1]overlay=10:10:format=yuv420[tmp1];'
+    '[tmp1][wm2]overlay=W-w-10:H-h-10:format=yuv420'
+)
+
+X264_ARGS = (
+    '-c:v', 'libx264',
+    '-preset', 'ultrafast',
+    '-crf', '23',
+    '-threads', '0',
+)
+NVENC_ARGS = (
+    '-c:v', 'h264_nvenc',
+    '-preset', 'p1',
+    '-tune', 'll',
+    '-rc', 'vbr',
+    '-cq', '23',
+)
+
+@functools.lru_cache(maxsize=1)
+def _video_encoder_args() -> tuple:
+    """
+    Argumentos do encoder de vídeo, detectados uma vez.
+    NVENC só é usado se um encode de teste funcionar - o build do FFmpeg pode
+    ter h264_nvenc sem haver GPU/driver na máquina. O overlay continua na CPU.
+    """
+    if VIDEO_HWENC:
+        try:
+            probe = subprocess.run([
+                FFMPEG_BIN, '-hide_banner', '-v', 'error',
+                '-f', 'lavfi', '-i', 'color=s=256x256:d=0.1',
+                *NVENC_ARGS, '-f', 'null', '-'
+            ], capture_output=True, timeout=30)
+            if probe.returncode == 0:
+                log.info("Encoder de vídeo: h264_nvenc (GPU)")
+                return NVENC_ARGS
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+    return X264_ARGS
+
+def _progress_total_size(progress: bytes) -> int | None:
+    """Extrai o último total_size reportado pelo -progress do FFmpeg."""
+    total_size = None
+    for line in progress.decode(errors='ignore').splitlines():
+        if line.startswith('total_size='):
+            value = line[len('total_size='):]
+            if value.isdigit():
+                total_size = int(value)
+    return total_size
+
+
+def add_watermark_video(input_path: str, output_path: str, input_size: int | None = None) -> bool:
     """
     Adiciona watermark em vídeo usando FFmpeg.
     Posiciona em diagonal: superior esquerdo e inferior direito.
+
+    input_size evita um stat no arquivo de entrada quando o chamador já sabe o tamanho.
     """
     try:
         # Verificar tamanho do arquivo de entrada
-        input_size = os.path.getsize(input_path)
+        if input_size is None:
+            input_size = os.stat(input_path).st_size
         if input_size < 1000:
             log.warning(f"Arquivo de entrada muito pequeno: {input_size} bytes")
             return False
 
-        # Filtro complexo para 2 watermarks em diagonal
-        filter_complex = (
-            '[1:v]scale=iw*0.225:-1,split=2[wm1][wm2];'
-            '[0:v][wm1]overlay=10:10[tmp1];'
-            '[tmp1][wm2]overlay=W-w-10:H-h-10'
-        )
         cmd = [
-            'ffmpeg', '-y',
+            FFMPEG_BIN, '-y',
+            '-nostats', '-progress', 'pipe:1',
             '-i', input_path,
             '-i', WATERMARK_PATH,
-            '-filter_complex', filter_complex,
-            '-c:v', 'libx264',
+            '-filter_complex', WATERMARK_FILTER,
+            *_video_encoder_args(),
+            '-pix_fmt', 'yuv420p',
             '-c:a', 'copy',
-            '-preset', 'ultrafast',
-            '-crf', '23',
-            '-threads', '0',
             '-movflags', '+faststart',
             output_path
         ]
@@ -328,12 +750,15 @@ def add_watermark_video(input_path: str, output_path: str) -> bool:
             log.warning(f"FFmpeg erro: {result.stderr.decode()[-300:]}")
             return False
 
-        # Verificar se arquivo de saída existe e tem tamanho razoável
-        if not os.path.exists(output_path):
-            log.warning("FFmpeg não criou arquivo de saída")
-            return False
+        # Tamanho de saída vem do próprio FFmpeg (-progress); stat só se ausente
+        output_size = _progress_total_size(result.stdout)
+        if output_size is None:
+            try:
+                output_size = os.stat(output_path).st_size
+            except FileNotFoundError:
+                log.warning("FFmpeg não criou arquivo de saída")
+                return False
 
-        output_size = os.path.getsize(output_path)
         if output_size < 1000:
             log.warning(f"Arquivo de saída muito pequeno: {output_size} bytes")
             os.remove(output_path)
@@ -355,6 +780,77 @@ def add_watermark_video(input_path: str, output_path: str) -> bool:
         return False
 
 
+# Pontos de tempo para tentar extrair frame (em segundos)
+# Inclui mais pontos para vídeos longos que podem ter keyframes esparsos
+THUMB_TIME_POINTS = ['0', '0.5', '1', '2', '3', '5', '10']
+THUMB_WIDTH = 320
+# Frames analisados pelo filtro thumbnail (~4s a 25fps) na tentativa única
+THUMB_SCAN_FRAMES = 100
+
+
+def _generate_thumbnail_pyav(video_path: str, thumb_path: str) -> bool:
+    """
+    Gera thumbnail com PyAV: abre o vídeo uma vez e tenta todos os pontos
+    de tempo com o decoder aquecido. Seek por keyframe (como -ss antes de -i).
+    """
+    try:
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            for time_point in THUMB_TIME_POINTS:
+                try:
+                    container.seek(int(float(time_point) * av.time_base), any_frame=False)
+                    frame = next(container.decode(stream), None)
+                    if frame is None:
+                        continue
+
+                    image = frame.to_image()
+                    height = max(1, round(image.height * THUMB_WIDTH / image.width))
+                    image.resize((THUMB_WIDTH, height), Image.Resampling.BILINEAR).save(
+                        thumb_path, 'JPEG', quality=90
+                    )
+
+                    thumb_size = os.path.getsize(thumb_path)
+                    if thumb_size > 100:
+                        log.debug(f"Thumbnail (PyAV) gerado em t={time_point}s: {thumb_size} bytes")
+                        return True
+                    os.remove(thumb_path)
+                except Exception as e:
+                    log.debug(f"PyAV falhou em t={time_point}s: {e}")
+    except Exception as e:
+        log.debug(f"PyAV não abriu {video_path}: {e}")
+    return False
+
+
+def _generate_thumbnail_single_pass(video_path: str, thumb_path: str) -> bool:
+    """
+    Uma única chamada do FFmpeg: o filtro thumbnail escolhe o frame mais
+    representativo entre os primeiros THUMB_SCAN_FRAMES (evita frame preto
+    inicial). Decodifica desde o início, então serve também para previews.
+    """
+    try:
+        result = subprocess.run([
+            FFMPEG_BIN, '-y',
+            '-fflags', '+discardcorrupt',
+            '-i', video_path,
+            '-map', '0:v:0', '-an', '-sn', '-dn',
+            '-vf', f'thumbnail={THUMB_SCAN_FRAMES},scale={THUMB_WIDTH}:-1',
+            '-frames:v', '1',
+            '-q:v', '2',
+            thumb_path
+        ], capture_output=True, timeout=60)
+        if result.returncode != 0:
+            return False
+        thumb_size = os.path.getsize(thumb_path)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.debug(f"Thumbnail em passada única falhou: {e}")
+        return False
+    if thumb_size > 100:
+        log.debug(f"Thumbnail gerado (passada única): {thumb_size} bytes")
+        return True
+    os.remove(thumb_path)
+    return False
+
+
 def generate_video_thumbnail(video_path: str, thumb_path: str, is_preview: bool = False) -> bool:
     """
     Gera thumbnail de vídeo de forma robusta.
@@ -363,30 +859,40 @@ def generate_video_thumbnail(video_path: str, thumb_path: str, is_preview: bool
     Para vídeos grandes (is_preview=True), usa seeking após input (-i) para maior precisão,
     pois arquivos de preview podem não ter índice completo.
     """
-    # Pontos de tempo para tentar extrair frame (inclui mais pontos para vídeos longos)
-    time_points = ['0', '0.5', '1', '2', '3', '5', '10']
+    # Vídeo completo: tentar em processo com PyAV antes de chamar o ffmpeg
+    if PYAV_SUPPORT and not is_preview:
+        if _generate_thumbnail_pyav(video_path, thumb_path):
+            return True
 
-    for time_point in time_points:
+    # Um único processo FFmpeg; os pontos de tempo abaixo ficam como fallback
+    if _generate_thumbnail_single_pass(video_path, thumb_path):
+        return True
+
+    for time_point in THUMB_TIME_POINTS:
         try:
             # Para previews de vídeos grandes: -ss DEPOIS de -i (mais preciso, mais lento)
             # Para vídeos completos: -ss ANTES de -i (mais rápido, usa keyframe seeking)
             if is_preview:
                 thumb_cmd = [
-                    'ffmpeg', '-y',
+                    FFMPEG_BIN, '-y',
+                    '-fflags', '+discardcorrupt',
                     '-i', video_path,
                     '-ss', time_point,
-                    '-vframes', '1',
-                    '-vf', 'scale=320:-1',
+                    '-map', '0:v:0', '-an', '-sn', '-dn',
+                    '-frames:v', '1',
+                    '-vf', f'scale={THUMB_WIDTH}:-1',
                     '-q:v', '2',
                     thumb_path
                 ]
             else:
                 thumb_cmd = [
-                    'ffmpeg', '-y',
+                    FFMPEG_BIN, '-y',
+                    '-fflags', '+discardcorrupt+fastseek',
                     '-ss', time_point,
                     '-i', video_path,
-                    '-vframes', '1',
-                    '-vf', 'scale=320:-1',
+                    '-map', '0:v:0', '-an', '-sn', '-dn',
+                    '-frames:v', '1',
+                    '-vf', f'scale={THUMB_WIDTH}:-1',
                     '-q:v', '2',
                     thumb_path
                 ]
@@ -396,13 +902,14 @@ def generate_video_thumbnail(video_path: str, thumb_path: str, is_preview: bool
             if result.returncode != 0:
                 continue
 
-            if os.path.exists(thumb_path):
+            try:
                 thumb_size = os.path.getsize(thumb_path)
-                if thumb_size > 100:
-                    log.debug(f"Thumbnail gerado em t={time_point}s: {thumb_size} bytes")
-                    return True
-                else:
-                    os.remove(thumb_path)
+            except FileNotFoundError:
+                continue
+            if thumb_size > 100:
+                log.debug(f"Thumbnail gerado em t={time_point}s: {thumb_size} bytes")
+                return True
+            os.remove(thumb_path)
 
         except subprocess.TimeoutExpired:
             log.debug(f"Timeout gerando thumbnail em t={time_point}s")
@@ -415,16 +922,53 @@ def generate_video_thumbnail(video_path: str, thumb_path: str, is_preview: bool
     return False
 
 
+def generate_preview_thumbnail(chunks: list, preview_path: str, thumb_path: str) -> bool:
+    """Grava os chunks de preview de uma vez e gera o thumbnail (roda no executor)."""
+    with open(preview_path, 'wb') as f:
+        f.writelines(chunks)
+    # is_preview=True usa seeking preciso (mais lento, mas funciona com arquivos parciais)
+    return generate_video_thumbnail(preview_path, thumb_path, is_preview=True)
+
+
+# Formatos de imagem aceitos no watermark (fotos do Telegram são JPEG)
+IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+@functools.lru_cache(maxsize=1)
+def _load_watermark() -> Image.Image:
+    """Decodifica a watermark uma única vez (arquivo constante)."""
+    with Image.open(WATERMARK_PATH) as watermark:
+        return watermark.convert('RGBA')
+
+
+# Larguras de imagem são agrupadas em faixas de 64px para reaproveitar o resize
+WATERMARK_WIDTH_BUCKET = 64
+
+@functools.lru_cache(maxsize=32)
+def _scaled_watermark(base_width: int) -> Image.Image:
+    """
+    Watermark com 22.5% da largura da imagem (50% maior que 15%).
+    O resultado é compartilhado entre chamadas - não modificar.
+    """
+    watermark = _load_watermark()
+    wm_width = int(base_width * 0.225)
+    wm_height = max(1, int(watermark.height * wm_width / watermark.width))
+    return watermark.resize((wm_width, wm_height), Image.Resampling.LANCZOS)
+
+
 def add_watermark_image(input_path: str, output_path: str) -> bool:
     """Adiciona watermark em imagem usando Pillow."""
     try:
-        base = Image.open(input_path).convert('RGBA')
-        watermark = Image.open(WATERMARK_PATH).convert('RGBA')
-
-        wm_width = int(base.width * 0.225)
-        wm_ratio = wm_width / watermark.width
-        wm_height = int(watermark.height * wm_ratio)
-        watermark = watermark.resize((wm_width, wm_height), Image.Resampling.LANCZOS)
+        # Formatos explícitos evitam testar todos os plugins do Pillow
+        base = Image.open(input_path, formats=IMAGE_FORMATS)
+        # paste() com máscara alfa já compõe em C direto sobre RGB/RGBA:
+        # JPEG (RGB) não precisa ir e voltar de RGBA no frame inteiro
+        if base.mode not in ('RGB', 'RGBA'):
+            base = base.convert('RGBA')
+
+        # Watermark redimensionada (cache por faixa de largura)
+        bucket = max(WATERMARK_WIDTH_BUCKET, base.width // WATERMARK_WIDTH_BUCKET * WATERMARK_WIDTH_BUCKET)
+        watermark = _scaled_watermark(bucket)
+        wm_width, wm_height = watermark.size
 
         positions = [
             (10, 10),
@@ -437,7 +981,8 @@ def add_watermark_image(input_path: str, output_path: str) -> bool:
         if output_path.lower().endswith('.png'):
             base.save(output_path, 'PNG')
         else:
-            base = base.convert('RGB')
+            if base.mode != 'RGB':
+                base = base.convert('RGB')
             base.save(output_path, 'JPEG', quality=95)
 
         return True
@@ -457,29 +1002,73 @@ class TopicManager:
         self.client = client
         self.topic_map: dict[int, int] = {}
         self.source_topics: dict[int, str] = {}
+        self._dirty = False
+        self._save_task: asyncio.Task | None = None
+        self._log_entries = 0  # Linhas em TOPIC_MAP_LOG ainda não compactadas
         self._load_map()
     
     def _load_map(self):
-        """Carrega mapeamento de tópicos do arquivo."""
-        import json
+        """Carrega mapeamento de tópicos do arquivo + criações registradas no log."""
         if os.path.exists(TOPIC_MAP_FILE):
             try:
                 with open(TOPIC_MAP_FILE, 'r') as f:
                     data = json.load(f)
                     self.topic_map = {int(k): int(v) for k, v in data.get('map', {}).items()}
                     self.source_topics = {int(k): v for k, v in data.get('names', {}).items()}
-                log.info(f"📋 Carregado mapeamento de {len(self.topic_map)} tópicos")
             except Exception as e:
                 log.warning(f"Erro ao carregar topic_map: {e}")
+        try:
+            with open(TOPIC_MAP_LOG, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Linha truncada (queda durante a escrita)
+                    self.topic_map[int(entry['src'])] = int(entry['tgt'])
+                    self._log_entries += 1
+        except FileNotFoundError:
+            pass
+        if self.topic_map:
+            log.info(f"📋 Carregado mapeamento de {len(self.topic_map)} tópicos")
+    
+    def _append_log(self, source_topic_id: int, target_topic_id: int):
+        """Registra uma criação de tópico em O(1), sem reescrever o mapa inteiro."""
+        with open(TOPIC_MAP_LOG, 'a') as f:
+            f.write(json.dumps({'src': source_topic_id, 'tgt': target_topic_id}) + '\n')
+        self._log_entries += 1
     
     def _save_map(self):
-        """Salva mapeamento de tópicos no arquivo."""
-        import json
-        with open(TOPIC_MAP_FILE, 'w') as f:
+        """Salva snapshot do mapeamento (escrita atômica) e descarta o log."""
+        tmp_file = f"{TOPIC_MAP_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
             json.dump({
                 'map': {str(k): v for k, v in self.topic_map.items()},
                 'names': {str(k): v for k, v in self.source_topics.items()}
-            }, f, indent=2)
+            }, f)
+        os.replace(tmp_file, TOPIC_MAP_FILE)
+        # Snapshot já contém tudo que estava no log
+        _remove_quiet(TOPIC_MAP_LOG)
+        self._log_entries = 0
+        self._dirty = False
+    
+    def _schedule_save(self):
+        """Marca o mapa como alterado e agenda uma única escrita em breve."""
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._debounced_save(TOPIC_MAP_SAVE_DELAY))
+    
+    async def _debounced_save(self, delay: float):
+        """Agrupa várias criações de tópico em uma escrita."""
+        await asyncio.sleep(delay)
+        if self._dirty:
+            self._save_map()
+    
+    async def flush(self):
+        """Grava alterações pendentes imediatamente (usar ao encerrar)."""
+        if self._save_task and not self._save_task.done():
+            self._save_task.cancel()
+        if self._dirty or self._log_entries:
+            self._save_map()
     
     async def load_source_topics(self, source_chat: int):
         """Carrega informações dos tópicos do chat de origem."""
@@ -487,18 +1076,35 @@ class TopicManager:
             return
         
         try:
-            result = await self.client(GetForumTopicsRequest(
-                channel=source_chat,
-                offset_date=0,
-                offset_id=0,
-                offset_topic=0,
-                limit=100
-            ))
-            
-            for topic in result.topics:
-                if hasattr(topic, 'id') and hasattr(topic, 'title'):
-                    self.source_topics[topic.id] = topic.title
+            # Paginar: a API retorna no máximo FORUM_TOPICS_PAGE tópicos por chamada
+            offset_date, offset_id, offset_topic = 0, 0, 0
+            while True:
+                result = await self.client(GetForumTopicsRequest(
+                    channel=source_chat,
+                    offset_date=offset_date,
+                    offset_id=offset_id,
+                    offset_topic=offset_topic,
+                    limit=FORUM_TOPICS_PAGE
+                ))
+                
+                for topic in result.topics:
+                    if hasattr(topic, 'id') and hasattr(topic, 'title'):
+                        self.source_topics[topic.id] = topic.title
+                
+                if len(result.topics) < FORUM_TOPICS_PAGE:
+                    break
+                last = result.topics[-1]
+                if last.id == offset_topic:
+                    break
+                offset_topic = last.id
+                offset_id = getattr(last, 'top_message', 0) or 0
+                # Tópicos vêm ordenados por última atividade: o offset_date é a data da
+                # top_message (em result.messages), não ForumTopic.date (criação)
+                top = next((m for m in result.messages if m.id == offset_id), None)
+                offset_date = top.date if top else 0
             
+            # Persistir nomes junto do mapeamento
+            self._schedule_save()
             log.info(f"📚 Carregados {len(self.source_topics)} tópicos da origem")
         except Exception as e:
             log.warning(f"Não foi possível carregar tópicos da origem: {e}")
@@ -529,12 +1135,21 @@ class TopicManager:
         try:
             log.info(f"📝 Criando tópico no destino: '{topic_name}'")
             
-            result = await self.client(CreateForumTopicRequest(
-                channel=target_chat,
-                title=topic_name,
-                icon_color=0x6FB9F0,
-                random_id=random.randrange(-2**62, 2**62)
-            ))
+            while True:
+                try:
+                    result = await self.client(CreateForumTopicRequest(
+                        channel=target_chat,
+                        title=topic_name,
+                        icon_color=0x6FB9F0,
+                        random_id=_random_id()
+                    ))
+                    break
+                except FloodWaitError as e:
+                    log.warning(f"FloodWait ao criar tópico: {e.seconds}s")
+                    await asyncio.sleep(e.seconds + 1)
+                    # Outra tarefa pode ter criado o tópico durante a espera
+                    if source_topic_id in self.topic_map:
+                        return self.topic_map[source_topic_id]
             
             new_topic_id = None
             if hasattr(result, 'updates'):
@@ -545,17 +1160,12 @@ class TopicManager:
             
             if new_topic_id:
                 self.topic_map[source_topic_id] = new_topic_id
-                self._save_map()
+                self._append_log(source_topic_id, new_topic_id)
                 log.info(f"✓ Tópico criado: '{topic_name}' (ID: {new_topic_id})")
                 return new_topic_id
             else:
                 return TARGET_TOPIC
                 
-        except FloodWaitError as e:
-            log.warning(f"FloodWait ao criar tópico: {e.seconds}s")
-            await asyncio.sleep(e.seconds + 1)
-            return await self.get_or_create_target_topic(source_topic_id, target_chat)
-            
         except Exception as e:
             log.error(f"Erro ao criar tópico '{topic_name}': {e}")
             return TARGET_TOPIC
@@ -565,52 +1175,97 @@ class TopicManager:
 # STREAMING UPLOADER
 # ============================================================
 
+class UploadPool:
+    """
+    Conexões extras para SaveBigFilePartRequest, distribuídas por parte.
+    Cada uma é um TelegramClient com a mesma auth_key da sessão principal,
+    sem receber updates - só multiplica as conexões TCP de upload.
+    """
+
+    def __init__(self, client: TelegramClient):
+        self.clients = [client]
+
+    async def start(self, connections: int):
+        if connections <= 1:
+            return
+        session = StringSession.save(self.clients[0].session)
+        for _ in range(connections - 1):
+            extra = TelegramClient(StringSession(session), API_ID, API_HASH, receive_updates=False)
+            await extra.connect()
+            self.clients.append(extra)
+        log.info(f"Upload: {len(self.clients)} conexões")
+
+    async def close(self):
+        for extra in self.clients[1:]:
+            await extra.disconnect()
+        del self.clients[1:]
+
+
 class StreamingUploader:
     """Upload de arquivo grande em streaming."""
     
-    def __init__(self, client: TelegramClient, file_size: int, file_name: str):
+    def __init__(self, client: TelegramClient, file_size: int | None, file_name: str,
+                 upload_clients: list | None = None):
         self.client = client
+        self.upload_clients = upload_clients or [client]
         self.file_size = file_size
         self.file_name = file_name
-        self.file_id = random.randrange(-2**62, 2**62)
-        self.total_parts = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.file_id = _random_id()
+        self.total_parts = -1
+        if file_size is not None:
+            self.set_file_size(file_size)
         self.parts_uploaded = 0
-        self.md5_hash = hashlib.md5()
-        self.semaphore = asyncio.Semaphore(PARALLEL_UPLOADS)
-        self.pending_tasks = []
+        self.pending_tasks: asyncio.Queue = asyncio.Queue(maxsize=BUFFER_CHUNKS)
     
+    def set_file_size(self, file_size: int):
+        """Define o tamanho final; sem ele as partes vão com total -1 (streaming)."""
+        self.file_size = file_size
+        self.total_parts = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
     async def upload_part(self, part_index: int, data: bytes) -> bool:
         """Upload de uma parte do arquivo."""
-        async with self.semaphore:
-            try:
-                result = await self.client(SaveBigFilePartRequest(
-                    file_id=self.file_id,
-                    file_part=part_index,
-                    file_total_parts=self.total_parts,
-                    bytes=data
-                ))
-                
-                if result:
-                    self.parts_uploaded += 1
-                    self.md5_hash.update(data)
-                    return True
-                return False
-                
-            except FloodWaitError as e:
-                log.warning(f"FloodWait no upload: {e.seconds}s")
-                await asyncio.sleep(e.seconds + 1)
-                return await self.upload_part(part_index, data)
+        client = self.upload_clients[part_index % len(self.upload_clients)]
+        async with _UPLOAD_SEMAPHORE:
+            # FloodWait: esperar segurando o slot (freia todos os uploads) e repetir
+            # no mesmo slot - recursão readquiriria o semáforo e podia travar
+            while True:
+                try:
+                    result = await client(SaveBigFilePartRequest(
+                        file_id=self.file_id,
+                        file_part=part_index,
+                        file_total_parts=self.total_parts,
+                        bytes=data
+                    ))
+                    break
+                except FloodWaitError as e:
+                    log.warning(f"FloodWait no upload: {e.seconds}s")
+                    await asyncio.sleep(e.seconds + 1)
+
+        if result:
+            self.parts_uploaded += 1
+            return True
+        return False
     
     async def upload_chunk(self, part_index: int, data: bytes):
         """Agenda upload de um chunk (não bloqueia)."""
         task = asyncio.create_task(self.upload_part(part_index, data))
-        self.pending_tasks.append(task)
-        self.pending_tasks = [t for t in self.pending_tasks if not t.done()]
+        if self.pending_tasks.full():
+            await self.pending_tasks.get_nowait()
+        self.pending_tasks.put_nowait(task)
     
     async def wait_completion(self):
         """Aguarda todos os uploads pendentes."""
-        if self.pending_tasks:
-            await asyncio.gather(*self.pending_tasks)
+        while not self.pending_tasks.empty():
+            await self.pending_tasks.get_nowait()
+
+    async def cancel(self):
+        """Cancela os uploads pendentes e aguarda o encerramento (abortar o arquivo)."""
+        tasks = []
+        while not self.pending_tasks.empty():
+            task = self.pending_tasks.get_nowait()
+            task.cancel()
+            tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
     
     def get_input_file(self) -> InputFileBig:
         """Retorna InputFile para usar no sendMedia."""
@@ -632,24 +1287,69 @@ class StreamingCloner:
     """
     
     def __init__(self, client: TelegramClient, checkpoint: SharedCheckpoint, 
-                 topic_manager: TopicManager = None):
+                 topic_manager: TopicManager = None, upload_pool: UploadPool = None):
         self.client = client
+        self.upload_clients = upload_pool.clients if upload_pool else [client]
         self.checkpoint = checkpoint
         self.topic_manager = topic_manager
-        self.last_send_time = 0
+        # Token bucket: começa cheio
+        self._tokens = float(RATE_LIMIT_BURST)
+        self._last_refill = time.monotonic()
+        self._target_peer = None  # InputPeer do destino, resolvido uma vez
+        self._reply_to_cache: dict[int, InputReplyToMessage] = {}
+    
+    async def _get_target_peer(self):
+        """Resolve TARGET_CHAT uma única vez por clonador."""
+        if self._target_peer is None:
+            self._target_peer = await self.client.get_input_entity(TARGET_CHAT)
+        return self._target_peer
+    
+    def _reply_to(self, topic: int | None) -> InputReplyToMessage | None:
+        """InputReplyToMessage por tópico (poucos tópicos, objeto reaproveitado)."""
+        if not topic:
+            return None
+        reply_to = self._reply_to_cache.get(topic)
+        if reply_to is None:
+            reply_to = self._reply_to_cache[topic] = InputReplyToMessage(reply_to_msg_id=topic)
+        return reply_to
     
     async def wait_rate_limit(self):
-        """Aguarda rate limit."""
-        elapsed = time.time() - self.last_send_time
-        if elapsed < MIN_INTERVAL:
-            await asyncio.sleep(MIN_INTERVAL - elapsed)
-        self.last_send_time = time.time()
+        """
+        Token bucket: permite rajadas de até RATE_LIMIT_BURST mensagens,
+        mantendo a média de 1 mensagem a cada MIN_INTERVAL.
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        if elapsed > 0:
+            self._tokens = min(RATE_LIMIT_BURST, self._tokens + elapsed / MIN_INTERVAL)
+            self._last_refill = now
+        # Reservar o token antes de dormir (seguro com chamadas concorrentes)
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens * MIN_INTERVAL)
+    
+    def drain_rate_limit(self, seconds: float):
+        """Esvazia o bucket após FloodWait; recarga só recomeça depois da espera."""
+        self._tokens = 0.0
+        self._last_refill = time.monotonic() + seconds
     
     async def clone_message(self, msg: Message) -> bool:
         """Clona uma mensagem com streaming e checkpoint compartilhado."""
+        # FloodWait em loop: recursão manteria frames (e buffers) vivos durante o sleep
+        while True:
+            try:
+                return await self._clone_message_once(msg)
+            except FloodWaitError as e:
+                log.warning(f"FloodWait: {e.seconds}s")
+                self.drain_rate_limit(e.seconds + 1)
+                await asyncio.sleep(e.seconds + 1)
+
+    async def _clone_message_once(self, msg: Message) -> bool:
+        """Uma tentativa de clone; FloodWaitError sobe para clone_message."""
         
         # Tentar fazer lock da mensagem
-        if not self.checkpoint.try_lock_message(SOURCE_CHAT, msg.id, SESSION_NAME):
+        if not await self.checkpoint.try_lock_message_async(SOURCE_CHAT, msg.id, SESSION_NAME,
+                                                            SOURCE_TOPIC or 0):
             log.debug(f"⊘ Msg {msg.id} já em processamento ou concluída")
             return False
         
@@ -720,11 +1420,9 @@ class StreamingCloner:
             self.checkpoint.mark_failed(SOURCE_CHAT, msg.id)
             return False
             
-        except FloodWaitError as e:
-            log.warning(f"FloodWait: {e.seconds}s")
-            await asyncio.sleep(e.seconds + 1)
-            # Não marcar como falha, vai tentar de novo
-            return await self.clone_message(msg)
+        except FloodWaitError:
+            # Não marcar como falha: clone_message espera e tenta de novo
+            raise
             
         except Exception as e:
             log.error(f"✗ Erro msg {msg.id}: {e}")
@@ -733,29 +1431,51 @@ class StreamingCloner:
     
     async def _clone_small_file(self, msg: Message, target_topic: int = None) -> bool:
         """Clone de arquivo pequeno (cabe em RAM)."""
-        import tempfile
-
         file_name = self._get_file_name(msg)
         file_size = self._get_file_size(msg)
 
         log.info(f"↓↑ Pequeno: {file_name} ({file_size/(1024*1024):.1f}MB)")
 
-        tmp_dir = tempfile.gettempdir()
+        # Detectar tipo de mídia
+        is_video = msg.video is not None
+        is_photo = msg.photo is not None
+
+        # Sem watermark, thumbnail ou metadados de áudio/vídeo: direto em RAM, sem disco
+        needs_file = (
+            is_video or msg.audio or msg.voice or msg.video_note or msg.gif or
+            (WATERMARK_ENABLED and is_photo)
+        )
+        if not needs_file:
+            buffer = io.BytesIO()
+            buffer.name = file_name  # Telethon deduz mime/filename pelo nome
+            await self.client.download_media(msg, file=buffer)
+            buffer.seek(0)
+            await self.client.send_file(
+                TARGET_CHAT,
+                buffer,
+                caption=msg.text or "",
+                reply_to=target_topic,
+                force_document=False
+            )
+            log.info(f"✓ Pequeno (RAM): msg {msg.id}")
+            return True
+
+        # Download para arquivo temporário com nome correto
+        tmp_dir = TMP_DIR
         tmp_path = os.path.join(tmp_dir, file_name)
         wm_path = os.path.join(tmp_dir, f"wm_{file_name}")
+        thumb_path = None
 
         try:
             await self.client.download_media(msg, file=tmp_path)
 
-            is_video = msg.video is not None
-            is_photo = msg.photo is not None
             supports_streaming = False
             upload_path = tmp_path
 
             if WATERMARK_ENABLED:
                 if is_video:
                     log.info(f"🎬 Aplicando watermark em vídeo...")
-                    if add_watermark_video(tmp_path, wm_path):
+                    if await _run_media(add_watermark_video, tmp_path, wm_path, file_size):
                         upload_path = wm_path
                         log.info(f"✓ Watermark aplicada")
                     else:
@@ -763,7 +1483,7 @@ class StreamingCloner:
 
                 elif is_photo:
                     log.info(f"🖼 Aplicando watermark em foto...")
-                    if add_watermark_image(tmp_path, wm_path):
+                    if await _run_media(add_watermark_image, tmp_path, wm_path):
                         upload_path = wm_path
                         log.info(f"✓ Watermark aplicada")
                     else:
@@ -772,14 +1492,12 @@ class StreamingCloner:
             video_attrs = None
             thumb_path = None
             if is_video:
-                for attr in (msg.video.attributes if msg.video else []):
-                    if isinstance(attr, DocumentAttributeVideo):
-                        supports_streaming = getattr(attr, 'supports_streaming', True)
-                        video_attrs = attr
-                        break
+                video_attrs = _attr_map(msg.video).get(DocumentAttributeVideo) if msg.video else None
+                if video_attrs:
+                    supports_streaming = getattr(video_attrs, 'supports_streaming', True)
 
                 thumb_path = os.path.join(tmp_dir, f"thumb_{file_name}.jpg")
-                if not generate_video_thumbnail(upload_path, thumb_path):
+                if not await _run_media(generate_video_thumbnail, upload_path, thumb_path):
                     thumb_path = None
 
             await self.client.send_file(
@@ -793,33 +1511,166 @@ class StreamingCloner:
                 attributes=[video_attrs] if video_attrs else None
             )
 
-            if thumb_path and os.path.exists(thumb_path):
-                os.remove(thumb_path)
-
             log.info(f"✓ Pequeno: msg {msg.id}")
             return True
 
         finally:
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-            if os.path.exists(wm_path):
-                os.remove(wm_path)
+            # Limpar arquivos temporários
+            await _cleanup(tmp_path, wm_path, thumb_path)
     
+    async def _watermark_video_piped(self, msg: Message, file_name: str,
+                                     thumb_path: str) -> tuple[StreamingUploader, bool] | None:
+        """
+        Watermark sem tocar o disco: iter_download → stdin do FFmpeg → stdout → upload.
+
+        A saída é MP4 fragmentado (dispensa seek). O mesmo FFmpeg grava em thumb_path
+        o thumbnail do vídeo já com a watermark. Retorna (uploader, thumbnail_ok),
+        ou None se o FFmpeg falhar.
+        """
+        encoder_args = await _run_media(_video_encoder_args)
+        # Saída com watermark dividida: vídeo para o pipe + um frame para o thumbnail
+        filter_complex = (
+            f'{WATERMARK_FILTER},split=2[vout][thumbsrc];'
+            f'[thumbsrc]scale={THUMB_WIDTH}:-1,thumbnail={THUMB_SCAN_FRAMES}[thumb]'
+        )
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, '-y', '-v', 'error',
+            '-i', 'pipe:0',
+            '-i', WATERMARK_PATH,
+            '-filter_complex', filter_complex,
+            '-map', '[vout]', '-map', '0:a:0?',
+            *encoder_args,
+            '-pix_fmt', 'yuv420p',
+            '-c:a', 'copy',
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-f', 'mp4', 'pipe:1',
+            '-map', '[thumb]', '-frames:v', '1', '-q:v', '2', thumb_path,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        uploader = StreamingUploader(self.client, None, file_name, self.upload_clients)
+
+        async def feed():
+            try:
+                async for chunk in self.client.iter_download(
+                    msg.media,
+                    chunk_size=CHUNK_SIZE,
+                    request_size=CHUNK_SIZE
+                ):
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # FFmpeg encerrou antes; o returncode diz se foi erro
+            finally:
+                proc.stdin.close()
+
+        async def upload_output() -> int:
+            # A última parte fica retida até o EOF para levar o total correto
+            part = 0
+            size = 0
+            held = None
+            while True:
+                try:
+                    data = await proc.stdout.readexactly(CHUNK_SIZE)
+                    eof = False
+                except asyncio.IncompleteReadError as e:
+                    data, eof = e.partial, True
+                if data:
+                    if held is not None:
+                        await uploader.upload_chunk(part, held)
+                        part += 1
+                    held = data
+                    size += len(data)
+                if eof:
+                    break
+            if held is not None:
+                uploader.set_file_size(size)
+                await uploader.upload_chunk(part, held)
+            return size
+
+        # gather não cancela as irmãs quando uma falha: tasks explícitas para o finally
+        tasks = [
+            asyncio.create_task(feed()),
+            asyncio.create_task(upload_output()),
+            asyncio.create_task(proc.stderr.read()),
+        ]
+        completed = False
+        try:
+            _, output_size, stderr = await asyncio.gather(*tasks)
+            await proc.wait()
+            await uploader.wait_completion()
+            completed = True
+        finally:
+            if not completed:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if not completed:
+                await uploader.cancel()
+
+        if proc.returncode != 0:
+            log.warning(f"FFmpeg (pipe) erro: {stderr.decode(errors='ignore')[-300:]}")
+            return None
+        if output_size < 1000:
+            log.warning(f"Saída do FFmpeg (pipe) muito pequena: {output_size} bytes")
+            return None
+        try:
+            thumb_ok = os.path.getsize(thumb_path) > 100  # tmpfs: stat sem I/O real
+        except OSError:
+            thumb_ok = False
+        return uploader, thumb_ok
+
     async def _clone_large_video_with_watermark(self, msg: Message, target_topic: int = None) -> bool:
         """
         Clone de vídeo grande COM watermark.
         
-        Requer download completo → processamento FFmpeg → upload.
+        Com WATERMARK_PIPE (e vídeo supports_streaming) tenta primeiro
+        download → FFmpeg → upload por pipes;
+        senão (ou se falhar) download completo → processamento FFmpeg → upload.
         Mais lento que streaming puro, mas aplica a marca d'água.
         """
-        import tempfile
-
         file_name = self._get_file_name(msg)
         file_size = self._get_file_size(msg)
 
         log.info(f"🎬 Grande c/ watermark: {file_name} ({file_size/(1024*1024):.1f}MB)")
 
-        tmp_dir = tempfile.gettempdir()
+        # Sem supports_streaming o moov costuma estar no fim do arquivo: o FFmpeg só
+        # o leria depois do pipe inteiro (download e partes desperdiçados antes do
+        # fallback). Esses vão direto para o caminho em disco.
+        video_attrs = _attr_map(msg.video).get(DocumentAttributeVideo) if msg.video else None
+        if WATERMARK_PIPE and video_attrs and video_attrs.supports_streaming:
+            start_time = time.time()
+            pipe_thumb_path = os.path.join(TMP_DIR, f"thumb_{file_name}.jpg")
+            try:
+                try:
+                    piped = await self._watermark_video_piped(msg, file_name, pipe_thumb_path)
+                except Exception as e:
+                    log.warning(f"⚠ Watermark via pipe falhou: {e}")
+                    piped = None
+                if piped:
+                    uploader, thumb_ok = piped
+                    # Thumbnail do vídeo processado (com watermark), como no caminho em disco
+                    thumb_input_file = await self.client.upload_file(pipe_thumb_path) if thumb_ok else None
+                    media = self._create_input_media(msg, uploader.get_input_file(), thumb=thumb_input_file)
+                    reply_to = self._reply_to(target_topic)
+                    await self.client(SendMediaRequest(
+                        peer=await self._get_target_peer(),
+                        media=media,
+                        message=msg.text or "",
+                        reply_to=reply_to
+                    ))
+                    total_time = time.time() - start_time
+                    log.info(f"✓ Grande c/ watermark (pipe): msg {msg.id} (total: {total_time:.1f}s)")
+                    return True
+            finally:
+                await _cleanup(pipe_thumb_path)
+            log.info("↺ Usando download completo para a watermark")
+
+        tmp_dir = DISK_TMP_DIR
         tmp_path = os.path.join(tmp_dir, file_name)
         wm_path = os.path.join(tmp_dir, f"wm_{file_name}")
         thumb_path = os.path.join(tmp_dir, f"thumb_{file_name}.jpg")
@@ -838,7 +1689,7 @@ class StreamingCloner:
             wm_start = time.time()
             
             upload_path = tmp_path
-            if add_watermark_video(tmp_path, wm_path):
+            if await _run_media(add_watermark_video, tmp_path, wm_path, file_size):
                 upload_path = wm_path
                 wm_time = time.time() - wm_start
                 log.info(f"✓ Watermark aplicada em {wm_time:.1f}s")
@@ -846,18 +1697,16 @@ class StreamingCloner:
                 log.warning(f"⚠ Falha na watermark, enviando original")
 
             # 3. Gerar thumbnail do vídeo processado
-            thumb_generated = generate_video_thumbnail(upload_path, thumb_path, is_preview=False)
+            thumb_generated = await _run_media(generate_video_thumbnail, upload_path, thumb_path, is_preview=False)
             if thumb_generated:
                 log.debug(f"✓ Thumbnail gerado")
 
             # 4. Extrair atributos do vídeo original
             supports_streaming = True
             video_attrs = None
-            for attr in (msg.video.attributes if msg.video else []):
-                if isinstance(attr, DocumentAttributeVideo):
-                    supports_streaming = getattr(attr, 'supports_streaming', True)
-                    video_attrs = attr
-                    break
+            video_attrs = _attr_map(msg.video).get(DocumentAttributeVideo) if msg.video else None
+            if video_attrs:
+                supports_streaming = getattr(video_attrs, 'supports_streaming', True)
 
             # 5. Upload do vídeo processado
             log.info(f"↑ Enviando vídeo processado...")
@@ -885,39 +1734,39 @@ class StreamingCloner:
             return False
 
         finally:
-            for path in [tmp_path, wm_path, thumb_path]:
-                if path and os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except Exception:
-                        pass
+            # Limpar arquivos temporários
+            await _cleanup(tmp_path, wm_path, thumb_path)
     
     async def _clone_large_file_streaming(self, msg: Message, target_topic: int = None) -> bool:
         """Clone de arquivo grande com STREAMING REAL."""
-        import tempfile
-
         file_name = self._get_file_name(msg)
         file_size = self._get_file_size(msg)
         is_video = msg.video is not None
 
         log.info(f"⚡ Streaming: {file_name} ({file_size/(1024*1024):.1f}MB)")
 
-        uploader = StreamingUploader(self.client, file_size, file_name)
+        uploader = StreamingUploader(self.client, file_size, file_name, self.upload_clients)
 
-        tmp_dir = tempfile.gettempdir()
+        tmp_dir = TMP_DIR
         video_preview_path = os.path.join(tmp_dir, f"preview_{file_name}") if is_video else None
         thumb_path = os.path.join(tmp_dir, f"thumb_{file_name}.jpg") if is_video else None
         preview_bytes = 0
-        preview_file = None
+        preview_chunks = None  # Referências aos chunks; gravados só quando o preview fecha
         thumb_generated = False
+        thumb_task = None  # Upload do thumbnail gerado, em paralelo com os chunks
         # 10MB para preview - vídeos 16:9 HD/4K podem ter keyframes esparsos
         PREVIEW_SIZE = 10 * 1024 * 1024
 
-        if is_video:
-            preview_file = open(video_preview_path, 'wb')
+        # Thumbnail já codificado pelo Telegram: dispensa preview em disco + ffmpeg
+        thumb_input_file = await self._upload_cached_thumb(msg) if is_video else None
+
+        if is_video and thumb_input_file is None:
+            preview_chunks = []
 
         part_index = 0
         bytes_processed = 0
+        log_step = max(file_size // 10, 1)  # Log de progresso a cada 10%
+        next_log = log_step
         start_time = time.time()
 
         try:
@@ -928,39 +1777,40 @@ class StreamingCloner:
             ):
                 await uploader.upload_chunk(part_index, chunk)
 
-                if is_video and preview_file and preview_bytes < PREVIEW_SIZE:
-                    preview_file.write(chunk)
+                if preview_chunks is not None:
+                    preview_chunks.append(chunk)
                     preview_bytes += len(chunk)
 
-                    if preview_bytes >= PREVIEW_SIZE and not thumb_generated:
-                        preview_file.close()
-                        preview_file = None
+                    if preview_bytes >= PREVIEW_SIZE:
+                        chunks, preview_chunks = preview_chunks, None
                         log.debug(f"Gerando thumbnail de vídeo grande (preview={preview_bytes/(1024*1024):.1f}MB)...")
-                        thumb_generated = generate_video_thumbnail(video_preview_path, thumb_path, is_preview=True)
+                        thumb_generated = await _run_media(generate_preview_thumbnail, chunks, video_preview_path, thumb_path)
                         if thumb_generated:
                             log.debug(f"✓ Thumbnail gerado para vídeo grande")
+                            thumb_task = asyncio.create_task(self.client.upload_file(thumb_path))
 
                 bytes_processed += len(chunk)
                 part_index += 1
 
-                progress = bytes_processed / file_size * 100
-                if int(progress) % 10 == 0 and int(progress) > 0:
+                if bytes_processed >= next_log:
+                    next_log += log_step
+                    progress = bytes_processed / file_size * 100
                     elapsed = time.time() - start_time
                     speed = bytes_processed / elapsed / (1024 * 1024)
                     log.debug(f"  {progress:.0f}% ({speed:.1f} MB/s)")
 
-            if preview_file:
-                preview_file.close()
-                preview_file = None
-                if is_video and not thumb_generated and preview_bytes > 0:
-                    thumb_generated = generate_video_thumbnail(video_preview_path, thumb_path, is_preview=True)
+            if preview_chunks:
+                chunks, preview_chunks = preview_chunks, None
+                thumb_generated = await _run_media(generate_preview_thumbnail, chunks, video_preview_path, thumb_path)
+                if thumb_generated:
+                    thumb_task = asyncio.create_task(self.client.upload_file(thumb_path))
 
             await uploader.wait_completion()
 
-            thumb_input_file = None
-            if thumb_generated and thumb_path and os.path.exists(thumb_path):
+            # Fallback: thumbnail gerado a partir do preview (já subindo em paralelo)
+            if thumb_task:
                 try:
-                    thumb_input_file = await self.client.upload_file(thumb_path)
+                    thumb_input_file = await thumb_task
                 except Exception as e:
                     log.warning(f"Falha no upload do thumbnail: {e}")
                     thumb_input_file = None
@@ -968,9 +1818,9 @@ class StreamingCloner:
             input_file = uploader.get_input_file()
             media = self._create_input_media(msg, input_file, thumb=thumb_input_file)
 
-            reply_to = InputReplyToMessage(reply_to_msg_id=target_topic) if target_topic else None
+            reply_to = self._reply_to(target_topic)
             await self.client(SendMediaRequest(
-                peer=await self.client.get_input_entity(TARGET_CHAT),
+                peer=await self._get_target_peer(),
                 media=media,
                 message=msg.text or "",
                 reply_to=reply_to
@@ -983,43 +1833,71 @@ class StreamingCloner:
             return True
 
         finally:
-            if preview_file:
-                preview_file.close()
-            if video_preview_path and os.path.exists(video_preview_path):
-                os.remove(video_preview_path)
-            if thumb_path and os.path.exists(thumb_path):
-                os.remove(thumb_path)
+            if thumb_task and not thumb_task.done():
+                thumb_task.cancel()
+            await _cleanup(video_preview_path, thumb_path)
+    
+    async def _upload_cached_thumb(self, msg: Message):
+        """Reaproveita o thumbnail JPEG que o Telegram já mantém para o vídeo."""
+        sizes = [t for t in (msg.video.thumbs or []) if isinstance(t, PhotoSize)]
+        if not sizes:
+            return None
+        try:
+            thumb = max(sizes, key=lambda t: t.size)
+            thumb_bytes = await self.client.download_media(msg, thumb=thumb, file=bytes)
+            if thumb_bytes:
+                return await self.client.upload_file(thumb_bytes, file_name='thumb.jpg')
+        except Exception as e:
+            log.debug(f"Thumbnail do Telegram indisponível: {e}")
+        return None
     
     def _get_file_size(self, msg: Message) -> int:
-        """Retorna tamanho do arquivo."""
-        if msg.video:
-            return msg.video.size
-        if msg.document:
-            return msg.document.size
-        if msg.audio:
-            return msg.audio.size
-        if msg.voice:
-            return msg.voice.size
+        """Retorna tamanho do arquivo (memoizado na mensagem)."""
+        size = msg.__dict__.get('_sc_size')
+        if size is None:
+            size = msg.__dict__['_sc_size'] = self._compute_file_size(msg)
+        return size
+
+    def _compute_file_size(self, msg: Message) -> int:
+        # video/audio/voice são documentos: msg.document cobre todos sem as
+        # varreduras de atributos que cada uma dessas propriedades faz
+        doc = msg.document
+        if doc:
+            return doc.size
         if msg.photo:
-            return max(p.size for p in msg.photo.sizes if hasattr(p, 'size'))
+            # Telegram ordena os tamanhos do menor para o maior: o primeiro válido
+            # de trás para frente é o maior (stripped/cached ficam no início).
+            # PhotoSizeProgressive guarda os tamanhos das camadas; a última é a imagem completa
+            for p in reversed(msg.photo.sizes):
+                if isinstance(p, PhotoSize):
+                    return p.size
+                if isinstance(p, PhotoSizeProgressive) and p.sizes:
+                    return p.sizes[-1]
+            return 0
         return 0
     
     def _get_file_name(self, msg: Message) -> str:
-        """Retorna nome do arquivo."""
+        """Retorna nome do arquivo (memoizado na mensagem)."""
+        name = msg.__dict__.get('_sc_name')
+        if name is None:
+            name = msg.__dict__['_sc_name'] = self._compute_file_name(msg)
+        return name
+
+    def _compute_file_name(self, msg: Message) -> str:
         if msg.document:
-            for attr in msg.document.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    return attr.file_name
+            name_attr = _attr_map(msg.document).get(DocumentAttributeFilename)
+            if name_attr:
+                return name_attr.file_name
         if msg.video:
-            for attr in msg.video.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    return attr.file_name
+            name_attr = _attr_map(msg.video).get(DocumentAttributeFilename)
+            if name_attr:
+                return name_attr.file_name
             ext = msg.video.mime_type.split('/')[-1] if msg.video.mime_type else 'mp4'
             return f"video_{msg.id}.{ext}"
         if msg.audio:
-            for attr in msg.audio.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    return attr.file_name
+            name_attr = _attr_map(msg.audio).get(DocumentAttributeFilename)
+            if name_attr:
+                return name_attr.file_name
             ext = msg.audio.mime_type.split('/')[-1] if msg.audio.mime_type else 'mp3'
             return f"audio_{msg.id}.{ext}"
         if msg.photo:
@@ -1074,10 +1952,20 @@ async def main():
     stats_db = checkpoint.get_stats(SOURCE_CHAT)
     log.info(f"Checkpoint: {stats_db['done']} feitas | {stats_db['processing']} em andamento | {stats_db['failed']} falhas")
     
+    # Prefixo contíguo já concluído: nem pedir essas mensagens ao servidor
+    resume_id = checkpoint.get_resume_id(SOURCE_CHAT, SOURCE_TOPIC or 0)
+    if resume_id:
+        log.info(f"Resumindo após msg {resume_id}")
+    
     stats = {'ok': 0, 'fail': 0, 'skip': 0, 'bytes': 0}
     start_time = time.time()
+    done_ids = checkpoint.load_done_ids(SOURCE_CHAT, resume_id)
+    scanned = 0
     
-    async with TelegramClient(SESSION_NAME, API_ID, API_HASH) as client:
+    # Sem loop de updates (o clone não escuta eventos); FloodWait curto
+    # (< flood_sleep_threshold) é dormido pelo próprio Telethon
+    async with TelegramClient(SESSION_NAME, API_ID, API_HASH, receive_updates=False,
+                              flood_sleep_threshold=60, connection_retries=10) as client:
         
         # Inicializar Topic Manager
         topic_manager = None
@@ -1086,48 +1974,57 @@ async def main():
             topic_manager = TopicManager(client)
             await topic_manager.load_source_topics(SOURCE_CHAT)
             
-        cloner = StreamingCloner(client, checkpoint, topic_manager=topic_manager)
+        upload_pool = UploadPool(client)
+        await upload_pool.start(UPLOAD_CONNECTIONS)
+        cloner = StreamingCloner(client, checkpoint, topic_manager=topic_manager, upload_pool=upload_pool)
         
         log.info("Conectado! Buscando mensagens...")
         
-        async for msg in client.iter_messages(
+        # Próximas páginas do histórico chegam enquanto a mensagem atual é clonada
+        messages = _prefetch(_iter_messages_resumable(
+            client,
             SOURCE_CHAT,
-            min_id=0,  # Começar do início, checkpoint vai filtrar
-            reverse=True
-        ):
-            # Filtrar por tópico
-            if SOURCE_TOPIC:
-                if getattr(msg, 'reply_to_msg_id', None) != SOURCE_TOPIC:
-                    if getattr(msg, 'reply_to', None):
-                        if getattr(msg.reply_to, 'reply_to_top_id', None) != SOURCE_TOPIC:
-                            continue
-                    else:
-                        continue
-            
-            # Verificar se já foi processada
-            if checkpoint.is_processed(SOURCE_CHAT, msg.id):
-                stats['skip'] += 1
-                continue
+            min_id=resume_id,  # Buracos após resume_id: done_ids/lock filtram
+            reply_to=SOURCE_TOPIC or None,  # Filtro de tópico no servidor (GetReplies)
+            wait_time=0  # Sem limit o Telethon dorme 1s a cada 100 msgs; FloodWait longo reabre a busca
+        ), PREFETCH_MESSAGES)
+        
+        try:
+            async for msg in messages:
+                # Verificar se já foi processada (conjunto em memória, recarregado periodicamente)
+                scanned += 1
+                if scanned % DONE_IDS_REFRESH == 0:
+                    done_ids |= await checkpoint.load_done_ids_async(SOURCE_CHAT, msg.id)
+                if msg.id in done_ids:
+                    stats['skip'] += 1
+                    continue
             
-            success = await cloner.clone_message(msg)
+                success = await cloner.clone_message(msg)
             
-            if success:
-                stats['ok'] += 1
-                stats['bytes'] += cloner._get_file_size(msg) or 0
-            elif success is False and not checkpoint.is_processed(SOURCE_CHAT, msg.id):
-                # Falha real (não skip por lock)
-                stats['fail'] += 1
+                if success:
+                    stats['ok'] += 1
+                    stats['bytes'] += cloner._get_file_size(msg) or 0
+                elif success is False and not await checkpoint.is_processed_async(SOURCE_CHAT, msg.id):
+                    # Falha real (não skip por lock)
+                    stats['fail'] += 1
             
-            # Log a cada 10
-            total = stats['ok'] + stats['fail']
-            if total > 0 and total % 10 == 0:
-                elapsed = (time.time() - start_time) / 60
-                rate = total / elapsed if elapsed > 0 else 0
-                gb = stats['bytes'] / (1024**3)
-                log.info(
-                    f"Progresso: {stats['ok']} ok | {stats['skip']} skip | "
-                    f"{rate:.1f} msg/min | {gb:.2f} GB"
-                )
+                # Log a cada 10
+                total = stats['ok'] + stats['fail']
+                if total > 0 and total % 10 == 0:
+                    elapsed = (time.time() - start_time) / 60
+                    rate = total / elapsed if elapsed > 0 else 0
+                    gb = stats['bytes'] / (1024**3)
+                    log.info(
+                        f"Progresso: {stats['ok']} ok | {stats['skip']} skip | "
+                        f"{rate:.1f} msg/min | {gb:.2f} GB"
+                    )
+        finally:
+            await messages.aclose()
+            # Gravar checkpoint e mapeamento de tópicos pendentes
+            await checkpoint.flush()
+            if topic_manager:
+                await topic_manager.flush()
+            await upload_pool.close()
     
     elapsed = (time.time() - start_time) / 60
     log.info("=" * 60)
@@ -1141,4 +2038,6 @@ async def main():
 
 
 if __name__ == "__main__":
+    if UVLOOP_SUPPORT:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())